@@ -3,17 +3,38 @@ import tempfile
 import shutil
 import sys
 from datetime import datetime
-from flask import Flask, request, render_template, send_file, redirect, url_for, flash, jsonify
+from flask import Flask, request, render_template, send_file, redirect, url_for, flash, jsonify, session, has_request_context, g
 from werkzeug.utils import secure_filename
 import google.generativeai as genai
-from io import BytesIO
+from io import BytesIO, StringIO
 import PyPDF2
 from pdfminer.high_level import extract_text as extract_text_pdfminer
-from docx import Document
+from xml.etree import ElementTree
 import subprocess
+import signal
+import threading
+import time
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
 import uuid
 import re
 from dotenv import load_dotenv
+import bisect
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import zipfile
+import cProfile
+import pstats
+import random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, ImageOps
 
 # Load environment variables from .env file
 load_dotenv()
@@ -28,21 +49,114 @@ import shutil
 print("pdflatex path from Python:", shutil.which("pdflatex"))
 
 # Configuration
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+# Point UPLOAD_FOLDER at shared storage when running several hosts, it doubles as the shared session store
+UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'md'}
+ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf', 'gif', 'bmp', 'tif', 'tiff', 'webp'}
+# Rasters are downscaled so they never exceed this DPI at full \textwidth/\textheight
+# (A4 with the 2.5cm margins used by our templates is roughly 6.3in x 9.7in)
+IMAGE_TARGET_DPI = int(os.getenv("IMAGE_TARGET_DPI", "300"))
+IMAGE_TEXTWIDTH_INCHES = float(os.getenv("IMAGE_TEXTWIDTH_INCHES", "6.3"))
+IMAGE_TEXTHEIGHT_INCHES = float(os.getenv("IMAGE_TEXTHEIGHT_INCHES", "9.7"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "90"))
+# Limits applied to every pdflatex/bibtex run
+COMPILE_TIMEOUT_SECONDS = int(os.getenv("COMPILE_TIMEOUT_SECONDS", "60"))
+COMPILE_CPU_SECONDS = int(os.getenv("COMPILE_CPU_SECONDS", "60"))
+COMPILE_MEMORY_MB = int(os.getenv("COMPILE_MEMORY_MB", "2048"))
+COMPILE_MAX_OUTPUT_MB = int(os.getenv("COMPILE_MAX_OUTPUT_MB", "100"))
+COMPILE_MAX_LOG_BYTES = 64 * 1024
+COMPILE_MODES = ('check', 'draft', 'final')
+# Background compile of each newly saved revision, so the usual next Compile click is answered instantly
+SPECULATIVE_COMPILE_ENABLED = os.getenv("SPECULATIVE_COMPILE_ENABLED", "true").lower() in ('1', 'true', 'yes')
+SPECULATIVE_COMPILE_WORKERS = int(os.getenv("SPECULATIVE_COMPILE_WORKERS", "1"))
+SPECULATIVE_COMPILE_NICENESS = int(os.getenv("SPECULATIVE_COMPILE_NICENESS", "19"))
+SPECULATIVE_COMPILE_MODE = 'final' # What the editor's Compile button requests
+# LLM calls: hard timeout, and optional hedging (a backup request when the primary is slower than usual)
+LLM_TIMEOUT_SECONDS = int(os.getenv("LLM_TIMEOUT_SECONDS", "300"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ('1', 'true', 'yes')
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_BACKUP_MODEL = os.getenv("LLM_HEDGE_BACKUP_MODEL", "") # Key in `models`, empty means same model
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "20")) # Until enough latencies are known
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_LATENCY_WINDOW = 200
+# Admission control: per pool of routes, how many requests run at once, how many may wait, and how many
+# of those (running or waiting) one client may hold. Override e.g. with ADMISSION_COMPILE_CONCURRENCY=8.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ('1', 'true', 'yes')
+ADMISSION_POOL_DEFAULTS = {
+    # pool: (concurrency, queue size, per-client budget)
+    'cheap': (64, 256, 32),
+    'upload': (4, 16, 2),
+    'compile': (os.cpu_count() or 2, 16, 2),
+    # The editor's automatic syntax checks and page previews, kept apart so they never use up the compile budget
+    'background': (os.cpu_count() or 2, 16, 2),
+    'llm': (8, 32, 2),
+}
+ADMISSION_LIMITS = {
+    pool: tuple(int(os.getenv(f"ADMISSION_{pool.upper()}_{setting}", default))
+                for setting, default in zip(('CONCURRENCY', 'QUEUE', 'PER_CLIENT'), defaults))
+    for pool, defaults in ADMISSION_POOL_DEFAULTS.items()
+}
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30")) # Longest wait for a slot
+ADMISSION_CLIENT_KEY = os.getenv("ADMISSION_CLIENT_KEY", "ip") # 'ip', or 'session' to budget per paper session
+# Behind a reverse proxy every request comes from the proxy: take the client IP from X-Forwarded-For instead
+ADMISSION_TRUST_FORWARDED = os.getenv("ADMISSION_TRUST_FORWARDED", "false").lower() in ('1', 'true', 'yes')
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 LATEX_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'latex')
+# Page preview: resolution limits and the time one page may take to render
+PREVIEW_DEFAULT_DPI = 96
+PREVIEW_MAX_DPI = int(os.getenv("PREVIEW_MAX_DPI", "300"))
+PREVIEW_RENDER_TIMEOUT = 20
+# On-demand request profiling: per request with the X-Profile-Token header, or a sampled fraction of requests.
+# Without a token and with a zero sample rate no profiling hooks are installed at all.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "") # Also guards the /admin/profiles endpoints
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(UPLOAD_FOLDER, '.profiles'))
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "200"))
+PROFILE_STACK_INTERVAL = 0.005 # Seconds between stack samples for the collapsed (flamegraph) output
+# Local bibliography library: .bib files (separated by os.pathsep) indexed for citation lookup
+BIBLIOGRAPHY_PATHS = [os.path.abspath(path) for path in os.getenv(
+    "BIBLIOGRAPHY_PATHS", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'references.bib')).split(os.pathsep) if path]
+BIBLIOGRAPHY_INDEX_PATH = os.getenv("BIBLIOGRAPHY_INDEX_PATH", os.path.join(UPLOAD_FOLDER, '.bibliography_index.json'))
+BIBLIOGRAPHY_CHECK_INTERVAL = 2.0 # Seconds between checks of the .bib files for changes
 
 # Initialize the app
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max upload
-app.secret_key = os.urandom(24)
 
 # Create upload directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(LATEX_TEMPLATE_PATH, exist_ok=True)
 
+def load_secret_key():
+    """Returns the key used to sign session cookies, identical in every worker process.
+
+    SECRET_KEY from the environment wins. Otherwise the first worker generates a key
+    and publishes it in the upload folder (the shared session store), and every other
+    worker, on this host or any host sharing that folder, picks up the same key.
+    """
+    secret_key = os.getenv("SECRET_KEY")
+    if secret_key:
+        return secret_key
+    key_path = os.path.join(UPLOAD_FOLDER, '.secret_key')
+    if not os.path.exists(key_path):
+        temp_path = f"{key_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(os.urandom(32).hex())
+        try:
+            # link() refuses to overwrite, so exactly one worker's key wins the race
+            os.link(temp_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(key_path, 'r') as f:
+        return f.read().strip()
+
+app.secret_key = load_secret_key()
+
 # Initialize Gemini
 genai.configure(api_key=GEMINI_API_KEY)
 
@@ -57,6 +171,9 @@ def check_latex_installation():
         return False
 
 HAS_LATEX = check_latex_installation()
+HAS_PDFTOPPM = shutil.which("pdftoppm") is not None # Renders preview pages (poppler-utils)
+if not HAS_PDFTOPPM:
+    print("WARNING: pdftoppm not found. The page preview will not work.")
 
 # Setup the Gemini model - correct names based on current API
 models = {
@@ -67,7 +184,23 @@ models = {
 }
 
 # Set the default model to a valid, current one
-current_model = "models/gemini-1.5-pro-latest"
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "models/gemini-1.5-pro-latest")
+
+def get_current_model():
+    """Returns the model for the current request.
+
+    An explicit 'model' in the request (form or JSON body) wins, then the choice
+    stored in the user's session by /set_model, then DEFAULT_MODEL. Nothing is
+    stored per process, so every worker resolves the same model for a user.
+    """
+    if has_request_context():
+        data = request.get_json(silent=True) if request.is_json else None
+        model_key = (data or {}).get('model') or request.values.get('model')
+        if model_key in models:
+            return models[model_key]
+        if session.get('model') in models.values():
+            return session['model']
+    return DEFAULT_MODEL
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -90,11 +223,135 @@ def extract_text_from_pdf(file_path):
         print(f"Error extracting text from PDF: {e}")
         return ""
 
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+HEADING_STYLE_RE = re.compile(r'^heading\s*(\d)$', re.IGNORECASE)
+LIST_STYLE_RE = re.compile(r'^list\s*(bullet|number|paragraph)', re.IGNORECASE)
+
+def read_docx_styles(docx_zip):
+    """Reads word/styles.xml into (heading_levels, list_style_ids).
+
+    heading_levels maps style ids to heading levels (Title is level 1, 'heading N'
+    is N + 1); list_style_ids holds styles that number their paragraphs.
+    """
+    heading_levels = {}
+    list_style_ids = set()
+    try:
+        styles_file = docx_zip.open('word/styles.xml')
+    except KeyError:
+        return heading_levels, list_style_ids
+    with styles_file:
+        for _, elem in ElementTree.iterparse(styles_file):
+            if elem.tag != f'{WORD_NS}style':
+                continue
+            style_id = elem.get(f'{WORD_NS}styleId')
+            name_elem = elem.find(f'{WORD_NS}name')
+            name = name_elem.get(f'{WORD_NS}val', '') if name_elem is not None else ''
+            match = HEADING_STYLE_RE.match(name)
+            if name.lower() == 'title':
+                heading_levels[style_id] = 1
+            elif match:
+                heading_levels[style_id] = min(int(match.group(1)) + 1, 4)
+            elif LIST_STYLE_RE.match(name) or elem.find(f'{WORD_NS}pPr/{WORD_NS}numPr') is not None:
+                list_style_ids.add(style_id)
+            elem.clear()
+    return heading_levels, list_style_ids
+
+def iter_docx_blocks(file_path):
+    """Streams a DOCX body as Markdown-ish blocks without building the document model.
+
+    word/document.xml is parsed incrementally straight from the zip and every
+    paragraph or table is discarded as soon as it has been emitted, so memory stays
+    flat no matter how long the document is. Yields (kind, text) with kind one of
+    'heading', 'list_item', 'table_row' or 'paragraph'; headings already carry
+    their '#' markers, list items their '- ', table rows are '| a | b |' lines (the
+    first row of a table is followed by its '| --- |' separator line) and bold
+    runs are wrapped in '**'.
+    """
+    with zipfile.ZipFile(file_path) as docx_zip:
+        heading_styles, list_styles = read_docx_styles(docx_zip)
+        with docx_zip.open('word/document.xml') as document_file:
+            body = None
+            table_depth = 0
+            row_cells = None
+            cell_parts = None
+            table_rows = 0
+            runs = []
+            for event, elem in ElementTree.iterparse(document_file, events=('start', 'end')):
+                tag = elem.tag
+                if event == 'start':
+                    if tag == f'{WORD_NS}body':
+                        body = elem
+                    elif tag == f'{WORD_NS}tbl':
+                        table_depth += 1
+                        if table_depth == 1:
+                            table_rows = 0
+                    elif tag == f'{WORD_NS}tr' and table_depth == 1:
+                        row_cells = []
+                    elif tag == f'{WORD_NS}tc' and table_depth == 1:
+                        cell_parts = []
+                    continue
+
+                if tag == f'{WORD_NS}r':
+                    text = ''.join(
+                        child.text or '' if child.tag == f'{WORD_NS}t' else '\t' if child.tag == f'{WORD_NS}tab' else ' '
+                        for child in elem
+                        if child.tag in (f'{WORD_NS}t', f'{WORD_NS}tab', f'{WORD_NS}br', f'{WORD_NS}cr')
+                    )
+                    bold = elem.find(f'{WORD_NS}rPr/{WORD_NS}b')
+                    if text.strip() and bold is not None and bold.get(f'{WORD_NS}val', 'true') not in ('0', 'false'):
+                        text = f"**{text}**"
+                    runs.append(text)
+                elif tag == f'{WORD_NS}p':
+                    text = ''.join(runs).replace('****', '').strip()
+                    runs = []
+                    if table_depth:
+                        if cell_parts is not None and text:
+                            cell_parts.append(text)
+                    elif text:
+                        style = elem.find(f'{WORD_NS}pPr/{WORD_NS}pStyle')
+                        style_id = style.get(f'{WORD_NS}val') if style is not None else None
+                        level = heading_styles.get(style_id)
+                        if level:
+                            yield 'heading', f"{'#' * level} {text.replace('**', '')}"
+                        elif style_id in list_styles or elem.find(f'{WORD_NS}pPr/{WORD_NS}numPr') is not None:
+                            yield 'list_item', f"- {text}"
+                        else:
+                            yield 'paragraph', text
+                elif tag == f'{WORD_NS}tc' and table_depth == 1:
+                    row_cells.append(' '.join(cell_parts))
+                    cell_parts = None
+                elif tag == f'{WORD_NS}tr' and table_depth == 1:
+                    if any(row_cells):
+                        row = '| ' + ' | '.join(cell.replace('|', '\\|') for cell in row_cells) + ' |'
+                        if not table_rows:
+                            # Markdown tables need a header row: the first row of the table is it
+                            row += '\n|' + ' --- |' * len(row_cells)
+                        table_rows += 1
+                        yield 'table_row', row
+                    row_cells = None
+                elif tag == f'{WORD_NS}tbl':
+                    table_depth -= 1
+                else:
+                    continue
+
+                # Free everything that has been consumed; top-level blocks are dropped from the body too
+                if tag in (f'{WORD_NS}p', f'{WORD_NS}tbl') and not table_depth and body is not None:
+                    body.clear()
+                elif tag != f'{WORD_NS}r':
+                    elem.clear()
+
 def extract_text_from_docx(file_path):
     try:
-        doc = Document(file_path)
-        text = '\n'.join([paragraph.text for paragraph in doc.paragraphs])
-        return text
+        # List items and table rows stay on consecutive lines so they form one list or table,
+        # every other block is its own paragraph
+        parts = []
+        previous_kind = None
+        for kind, text in iter_docx_blocks(file_path):
+            if parts:
+                parts.append('\n' if kind == previous_kind and kind in ('list_item', 'table_row') else '\n\n')
+            parts.append(text)
+            previous_kind = kind
+        return ''.join(parts)
     except Exception as e:
         print(f"Error extracting text from DOCX: {e}")
         return ""
@@ -111,9 +368,386 @@ def extract_text_from_file(file_path):
             return file.read()
     return ""
 
-def generate_research_paper_structure(text, title=None):
+# Recent successful call latencies per model, used to place the hedge deadline
+llm_latencies = {}
+llm_stats = {'requests': 0, 'hedged': 0, 'primary_wins': 0, 'backup_wins': 0, 'failures': 0}
+llm_stats_lock = threading.Lock()
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix='llm')
+
+def get_hedge_delay(model_name):
+    """Seconds to wait for the primary call before hedging: the configured percentile of recent latencies."""
+    with llm_stats_lock:
+        samples = sorted(llm_latencies.get(model_name, ()))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_INITIAL_DELAY
+    index = min(len(samples) - 1, int(len(samples) * LLM_HEDGE_PERCENTILE / 100))
+    return max(LLM_HEDGE_MIN_DELAY, samples[index])
+
+def call_llm(model_name, prompt, generation_config=None):
+    """One blocking Gemini call; returns the response text and records its latency."""
+    start = time.monotonic()
+    model = genai.GenerativeModel(model_name)
+    kwargs = {'request_options': {'timeout': LLM_TIMEOUT_SECONDS}}
+    if generation_config is not None:
+        kwargs['generation_config'] = generation_config
+    text = model.generate_content(prompt, **kwargs).text
+    with llm_stats_lock:
+        llm_latencies.setdefault(model_name, deque(maxlen=LLM_LATENCY_WINDOW)).append(time.monotonic() - start)
+    return text
+
+def generate_llm_text(prompt, model_name=None, generation_config=None):
+    """Generates text with the given model, hedging against slow responses when enabled.
+
+    With LLM_HEDGE_ENABLED, if the primary call has not answered by the
+    LLM_HEDGE_PERCENTILE latency of recent calls, a backup request goes to
+    LLM_HEDGE_BACKUP_MODEL (or the same model). The first non-empty answer wins;
+    the other call is cancelled if it has not started, otherwise its result is
+    dropped (a running HTTP call cannot be interrupted, LLM_TIMEOUT_SECONDS bounds it).
+    Raises the primary's exception if no call produced a result.
+    """
+    model_name = model_name or get_current_model()
+    with llm_stats_lock:
+        llm_stats['requests'] += 1
+    if not LLM_HEDGE_ENABLED:
+        try:
+            return call_llm(model_name, prompt, generation_config)
+        except Exception:
+            with llm_stats_lock:
+                llm_stats['failures'] += 1
+            raise
+
+    backup_model = models.get(LLM_HEDGE_BACKUP_MODEL, model_name)
+    primary = llm_executor.submit(call_llm, model_name, prompt, generation_config)
+    pending = {primary}
+    done, _ = wait(pending, timeout=get_hedge_delay(model_name))
+    if not done:
+        print(f"--- Hedging LLM request: {model_name} slow, backup to {backup_model} ---", file=sys.stderr)
+        with llm_stats_lock:
+            llm_stats['hedged'] += 1
+        pending.add(llm_executor.submit(call_llm, backup_model, prompt, generation_config))
+
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                text = future.result()
+            except Exception as e:
+                first_error = first_error or e
+                continue
+            if not text or not text.strip():
+                continue
+            for loser in pending:
+                loser.cancel()
+            with llm_stats_lock:
+                llm_stats['primary_wins' if future is primary else 'backup_wins'] += 1
+            return text
+
+    with llm_stats_lock:
+        llm_stats['failures'] += 1
+    raise first_error or ValueError('LLM returned an empty response')
+
+def get_llm_stats():
+    with llm_stats_lock:
+        stats = dict(llm_stats)
+        model_names = list(llm_latencies)
+    stats['hedge_rate'] = round(stats['hedged'] / stats['requests'], 4) if stats['requests'] else 0
+    stats['backup_win_rate'] = round(stats['backup_wins'] / stats['hedged'], 4) if stats['hedged'] else 0
+    stats['hedge_enabled'] = LLM_HEDGE_ENABLED
+    stats['hedge_delay_seconds'] = {name: round(get_hedge_delay(name), 3) for name in model_names}
+    return stats
+
+# --- Offline paper structuring: paragraph classification with keyword, TF-IDF and position heuristics ---
+PAPER_SECTIONS = ('introduction', 'methodology', 'results', 'discussion', 'conclusion')
+# Headings that name a section outright (matched against the lowercased heading text)
+SECTION_HEADING_RE = {
+    'abstract': re.compile(r'\b(abstract|summary|tl;?dr)\b'),
+    'introduction': re.compile(r'\b(introduction|background|motivation|overview|related work|problem statement)\b'),
+    'methodology': re.compile(r'\b(method|methods|methodology|approach|materials|setup|implementation|design|procedure|model|data ?set|data collection)\b'),
+    'results': re.compile(r'\b(results?|findings|evaluation|experiments?|benchmarks?|performance)\b'),
+    'discussion': re.compile(r'\b(discussion|analysis|limitations|implications|interpretation)\b'),
+    'conclusion': re.compile(r'\b(conclusions?|concluding|future work|outlook|final remarks)\b'),
+}
+# Phrases that give a paragraph's role away, counted once each
+SECTION_CUE_RE = {
+    'abstract': re.compile(r'\b(in this (paper|work|study|article),? we|this (paper|work|study|article) (presents|proposes|introduces|describes|investigates)|we (present|propose|introduce) (a|an|the)\b)'),
+    'introduction': re.compile(r'\b(recent(ly)?|in recent years|has (become|attracted|gained)|plays? an? (important|key|crucial) role|challenges?|motivat\w*|however,|little is known|prior work|previous (work|studies)|the goal of|we aim|this paper|is organized as follows)\b'),
+    'methodology': re.compile(r'\b(we (used|use|collected|trained|implemented|designed|applied|measured|sampled|conducted)|was (used|collected|trained|measured|computed)|were (used|collected|trained|measured|recruited|computed)|data ?set|participants|algorithm|procedure|parameters?|protocol|step \d|pipeline|architecture|equation|sampl\w+)\b'),
+    'results': re.compile(r'\b(results? (show|indicate|suggest|demonstrate)|we (found|observed|obtained)|achiev\w+|outperform\w*|accuracy|significant(ly)?|table \d|figure \d|fig\. ?\d|increase[ds]? (by|from)|decrease[ds]? (by|from)|compared (to|with)|\d+(\.\d+)? ?%)'),
+    'discussion': re.compile(r'\b(this (suggests|indicates|implies|may be|could be)|one (possible )?explanation|limitations?|interpret\w*|in contrast to|consistent with|surprising(ly)?|may (be due|explain|reflect)|implications?|caveat)\b'),
+    'conclusion': re.compile(r'\b(in (conclusion|summary)|to (conclude|summarize)|we (have )?(shown|demonstrated|presented)|future (work|research|directions)|overall,|this (paper|work|study) (has )?(shown|demonstrated)|we plan to|remains? (open|an open))\b'),
+}
+# Topic words that lean towards a section; weighted by TF-IDF so words common to every paragraph count little
+SECTION_LEXICON = {
+    'introduction': ('background', 'motivation', 'problem', 'important', 'challenge', 'field', 'recent', 'goal', 'question', 'aim', 'contribution', 'paper', 'research'),
+    'methodology': ('method', 'approach', 'data', 'dataset', 'model', 'train', 'algorithm', 'implement', 'design', 'experiment', 'setup', 'measure', 'sample', 'procedure', 'parameter', 'collect', 'feature', 'configur'),
+    'results': ('result', 'show', 'found', 'observ', 'accuracy', 'performance', 'improve', 'outperform', 'table', 'figure', 'increase', 'decrease', 'significant', 'score', 'error', 'achiev', 'baseline'),
+    'discussion': ('discuss', 'suggest', 'explain', 'interpret', 'limitation', 'implication', 'however', 'possibl', 'may', 'might', 'could', 'consistent', 'contrast', 'although'),
+    'conclusion': ('conclu', 'summar', 'future', 'overall', 'contribution', 'demonstrat', 'promising', 'direction', 'plan'),
+}
+# Where each section usually sits, as (center, width) over the relative position in the text
+SECTION_POSITION = {
+    'introduction': (0.1, 0.2),
+    'methodology': (0.35, 0.2),
+    'results': (0.6, 0.2),
+    'discussion': (0.78, 0.18),
+    'conclusion': (0.95, 0.12),
+}
+STRUCTURE_CUE_WEIGHT = 1.0
+STRUCTURE_LEXICON_WEIGHT = 2.0
+STRUCTURE_POSITION_WEIGHT = 1.0
+STRUCTURE_HEADING_BONUS = 50.0
+STRUCTURE_WORD_RE = re.compile(r'[a-z]{3,}')
+STRUCTURE_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9])')
+STRUCTURE_STOPWORDS = frozenset((
+    'the', 'and', 'for', 'that', 'this', 'with', 'are', 'was', 'were', 'from', 'have', 'has', 'had', 'not', 'but',
+    'can', 'its', 'their', 'which', 'these', 'those', 'been', 'also', 'such', 'than', 'into', 'more', 'our', 'all',
+    'other', 'they', 'them', 'there', 'then', 'when', 'where', 'while', 'each', 'both', 'some', 'any', 'use', 'used',
+    'using', 'one', 'two', 'will', 'would', 'should', 'about', 'between', 'over', 'only', 'most', 'very', 'who',
+))
+STRUCTURE_ABSTRACT_MAX_WORDS = 250
+# Plain-text headings: a short capitalized label line ending in a colon ("Introduction:")
+STRUCTURE_LABEL_RE = re.compile(r'^([A-Z0-9][^.!?:;]{0,60}):\s*(.*)$')
+STRUCTURE_LABEL_MAX_WORDS = 8
+STRUCTURE_TITLE_MAX_WORDS = 15
+
+def segment_paragraphs(text):
+    """Splits extracted text into blocks: ('heading', level, text) and ('paragraph', 0, text).
+
+    Blank lines separate paragraphs; Markdown headings ('#') and label lines such as
+    "Introduction:" are blocks of their own (a label naming a section may also be
+    followed by text on the same line), and consecutive list items stay together in
+    one paragraph.
+    """
+    blocks = []
+    for chunk in re.split(r'\n\s*\n', text.replace('\r\n', '\n')):
+        lines = []
+        for line in chunk.split('\n'):
+            stripped = line.strip()
+            label = STRUCTURE_LABEL_RE.match(stripped)
+            if label and len(label.group(1).split()) <= STRUCTURE_LABEL_MAX_WORDS \
+                    and (not label.group(2) or match_section_heading(label.group(1))):
+                if lines:
+                    blocks.append(('paragraph', 0, '\n'.join(lines)))
+                    lines = []
+                blocks.append(('heading', 1, label.group(1).strip()))
+                if label.group(2):
+                    lines.append(label.group(2))
+            elif stripped.startswith('#'):
+                if lines:
+                    blocks.append(('paragraph', 0, '\n'.join(lines)))
+                    lines = []
+                level = len(stripped) - len(stripped.lstrip('#'))
+                heading = stripped[level:].strip().replace('**', '')
+                if heading:
+                    blocks.append(('heading', level, heading))
+            elif stripped:
+                lines.append(stripped)
+        if lines:
+            blocks.append(('paragraph', 0, '\n'.join(lines)))
+    return blocks
+
+def match_section_heading(heading):
+    heading = heading.lower()
+    for section, pattern in SECTION_HEADING_RE.items():
+        if pattern.search(heading):
+            return section
+    return None
+
+def tfidf_vectors(token_lists):
+    """Unit-length TF-IDF vectors (dicts) for a list of token lists."""
+    document_frequency = {}
+    for tokens in token_lists:
+        for token in set(tokens):
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+    count = len(token_lists)
+    vectors = []
+    for tokens in token_lists:
+        vector = {}
+        for token in tokens:
+            vector[token] = vector.get(token, 0) + 1
+        for token, frequency in vector.items():
+            vector[token] = (1 + math.log(frequency)) * math.log((1 + count) / (1 + document_frequency[token]) + 1)
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        vectors.append({token: weight / norm for token, weight in vector.items()})
+    return vectors
+
+def tokenize_for_structure(text):
+    return [word for word in STRUCTURE_WORD_RE.findall(text.lower()) if word not in STRUCTURE_STOPWORDS]
+
+def score_paragraph_sections(text, vector, position):
+    """Heuristic score of one paragraph for each section in PAPER_SECTIONS."""
+    lowered = text.lower()
+    scores = []
+    for section in PAPER_SECTIONS:
+        cues = len(SECTION_CUE_RE[section].findall(lowered))
+        stems = SECTION_LEXICON[section]
+        lexicon = sum(weight for token, weight in vector.items() if token.startswith(stems))
+        center, width = SECTION_POSITION[section]
+        prior = math.exp(-((position - center) / width) ** 2 / 2)
+        scores.append(STRUCTURE_CUE_WEIGHT * min(cues, 3) + STRUCTURE_LEXICON_WEIGHT * lexicon
+                      + STRUCTURE_POSITION_WEIGHT * prior)
+    return scores
+
+def assign_sections_in_order(score_rows):
+    """Best labelling of paragraphs where sections never go backwards (intro before methods, ...).
+
+    Dynamic programming over (paragraph, section): O(paragraphs * sections).
+    """
+    section_count = len(PAPER_SECTIONS)
+    best = list(score_rows[0])
+    back = []
+    for row in score_rows[1:]:
+        pointers = []
+        running_index = 0
+        new_best = []
+        for section in range(section_count):
+            if best[section] > best[running_index]:
+                running_index = section
+            pointers.append(running_index)
+            new_best.append(best[running_index] + row[section])
+        back.append(pointers)
+        best = new_best
+    section = max(range(section_count), key=best.__getitem__)
+    labels = [section]
+    for pointers in reversed(back):
+        section = pointers[section]
+        labels.append(section)
+    return [PAPER_SECTIONS[index] for index in reversed(labels)]
+
+def extractive_abstract(paragraph_texts, vectors):
+    """Picks the sentences closest to the whole text (TF-IDF centroid), in their original order."""
+    centroid = {}
+    for vector in vectors:
+        for token, weight in vector.items():
+            centroid[token] = centroid.get(token, 0) + weight
+    sentences = []
+    for text in paragraph_texts:
+        if text.lstrip().startswith(('- ', '* ', '#')):
+            continue # List items and headings make poor abstract sentences
+        for sentence in STRUCTURE_SENTENCE_RE.split(' '.join(text.split('\n'))):
+            tokens = tokenize_for_structure(sentence)
+            if len(tokens) >= 4:
+                score = sum(centroid.get(token, 0) for token in set(tokens)) / math.sqrt(len(set(tokens)))
+                sentences.append((score, len(sentences), sentence.strip()))
+    chosen = []
+    words = 0
+    for score, index, sentence in sorted(sentences, reverse=True):
+        if len(chosen) >= 3 or words + len(sentence.split()) > STRUCTURE_ABSTRACT_MAX_WORDS:
+            break
+        chosen.append((index, sentence))
+        words += len(sentence.split())
+    return ' '.join(sentence for _, sentence in sorted(chosen))
+
+def classify_paper_sections(text):
+    """Sorts the paragraphs of free text into abstract, introduction, ... conclusion.
+
+    Returns (title, sections) where title is a leading '#' heading or a short first
+    line that names no section (or None) and sections maps 'abstract' and every PAPER_SECTIONS entry
+    to a list of Markdown paragraphs. Headings that name a section decide the label
+    of the paragraphs below them; all other paragraphs are scored with section cue
+    phrases, TF-IDF weighted topic words and a position prior, then labelled in
+    document order by assign_sections_in_order. Headings that name no section are
+    kept as subsections.
+    """
+    blocks = segment_paragraphs(text)
+    title = None
+    if blocks and blocks[0][0] == 'heading' and blocks[0][1] == 1 and not match_section_heading(blocks[0][2]):
+        title = blocks.pop(0)[2]
+    elif len(blocks) > 1 and blocks[0][0] == 'paragraph' and '\n' not in blocks[0][2] \
+            and len(blocks[0][2].split()) <= STRUCTURE_TITLE_MAX_WORDS \
+            and not blocks[0][2].endswith(('.', '!', '?', ':', ';', ',')) and not blocks[0][2].startswith(('- ', '* ')):
+        # A lone short line on top of plain text is its title
+        title = blocks.pop(0)[2]
+
+    # Paragraph texts with the section named by the heading above them, if any
+    paragraphs = []
+    heading_section = None
+    heading_level = 0
+    for kind, level, block_text in blocks:
+        if kind == 'heading':
+            section = match_section_heading(block_text)
+            if section:
+                heading_section, heading_level = section, level
+                continue
+            if level <= heading_level:
+                # A sibling of the section heading, not a subsection of it: leave the label to scoring
+                heading_section, heading_level = None, 0
+            # Demote so it nests inside the generated \section
+            paragraphs.append((f"{'#' * min(level + 1, 4)} {block_text}", heading_section))
+        else:
+            paragraphs.append((block_text, heading_section))
+
+    sections = {'abstract': []}
+    sections.update((section, []) for section in PAPER_SECTIONS)
+    if not paragraphs:
+        return title, sections
+
+    abstract = [text for text, section in paragraphs if section == 'abstract']
+    body = [(text, section) for text, section in paragraphs if section != 'abstract']
+    if not abstract and body and body[0][1] is None and not body[0][0].startswith('#') \
+            and SECTION_CUE_RE['abstract'].search(body[0][0].lower()) \
+            and len(body[0][0].split()) <= STRUCTURE_ABSTRACT_MAX_WORDS and len(body) > 2:
+        abstract = [body.pop(0)[0]]
+
+    if body:
+        texts = [text for text, _ in body]
+        vectors = tfidf_vectors([tokenize_for_structure(text) for text in texts])
+        score_rows = []
+        for index, ((paragraph, section), vector) in enumerate(zip(body, vectors)):
+            position = index / (len(body) - 1) if len(body) > 1 else 0.0
+            scores = score_paragraph_sections(paragraph, vector, position)
+            if section:
+                scores[PAPER_SECTIONS.index(section)] += STRUCTURE_HEADING_BONUS
+            score_rows.append(scores)
+        labels = assign_sections_in_order(score_rows)
+        for (paragraph, section), label in zip(body, labels):
+            # An explicit heading wins even if its section is out of the usual order
+            sections[section or label].append(paragraph)
+        if not abstract:
+            summary = extractive_abstract(texts, vectors)
+            if summary:
+                abstract = [summary]
+    sections['abstract'] = abstract
+    return title, sections
+
+def render_section_body(paragraphs):
+    # Same Markdown -> LaTeX pipeline as the plain upload conversion, per paragraph so the breaks survive
+    # escaping; escape_latex drops newlines, so the lines of a paragraph are joined with spaces first
+    if not paragraphs:
+        return "% No content was classified into this section yet."
+    return '\n\n'.join(
+        escape_latex(' '.join(finalize_latex_content(preprocess_markdown_to_latex(paragraph)).split())).strip()
+        for paragraph in paragraphs
+    )
+
+def structure_paper_locally(text, title=None, authors=None):
+    """Builds a full paper from templates/latex/template.tex without any network call.
+
+    Meant as an instant first draft and as the fallback when the LLM is unavailable.
+    """
+    detected_title, sections = classify_paper_sections(text or '')
+    with open(os.path.join(LATEX_TEMPLATE_PATH, 'template.tex'), 'r', encoding='utf-8') as f:
+        template = f.read()
+    values = {
+        'TITLE': escape_latex(title or detected_title or 'Research Paper'),
+        'AUTHOR': escape_latex(authors or ''),
+    }
+    for section in ('abstract',) + PAPER_SECTIONS:
+        values[section.upper()] = render_section_body(sections[section])
+    if '\\cite' not in ''.join(values.values()):
+        # Nothing to cite: skip the bibliography so no BibTeX run is needed
+        template = template.replace('\\bibliography{references}\n', '')
+    # One pass over the template, so placeholder-like text inside the content is left alone
+    return re.sub(r'%([A-Z]+)%', lambda match: values.get(match.group(1), match.group(0)), template)
+
+def generate_research_paper_structure(text, title=None, model_name=None, fallback=True):
+    """Structures free text into a LaTeX paper with the LLM.
+
+    If the LLM call fails, the offline structuring engine builds the paper instead,
+    unless fallback is False, in which case the error is raised.
+    """
     try:
-        model = genai.GenerativeModel(current_model)
         prompt = f"""
         Your task is to transform the following text into a properly structured academic research paper in arXiv style. 
         The paper should include:
@@ -137,45 +771,46 @@ def generate_research_paper_structure(text, title=None):
         Title (if specified): {title if title else 'Generate an appropriate title'}
         """
         
-        response = model.generate_content(prompt)
+        response_text = generate_llm_text(prompt, model_name)
         # Escape the generated content before returning
-        return escape_latex(response.text) 
+        return escape_latex(response_text) 
     except Exception as e:
         print(f"Error generating content with Gemini: {e}", file=sys.stderr)
-        # Escape the original text when using the fallback template
-        escaped_fallback_text = escape_latex(text)
-        # Return a basic LaTeX template using a RAW f-string
-        return fr"""\documentclass[12pt,a4paper]{{article}}
-\usepackage[utf8]{{inputenc}}
-\usepackage[T1]{{fontenc}}
-\usepackage{{amsmath}}
-\usepackage{{amsfonts}}
-\usepackage{{amssymb}}
-\usepackage{{graphicx}}
-\usepackage{{booktabs}}
-\usepackage{{url}}
-\usepackage[colorlinks=true,urlcolor=blue,citecolor=blue,linkcolor=blue]{{hyperref}}
-\usepackage[left=2.5cm,right=2.5cm,top=2.5cm,bottom=2.5cm]{{geometry}}
-\usepackage{{natbib}}
-\bibliographystyle{{plainnat}}
-
-\title{{{title if title else 'Research Paper'}}}
-\author{{Generated by Research Paper Service}}
-\date{{\today}}
-
-\begin{{document}}
-
-\maketitle
+        if not fallback:
+            raise
+        return structure_paper_locally(text, title)
+
+def get_ai_draft_path(session_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], session_id, 'ai_draft.json')
+
+def save_ai_draft(session_id, ai_draft):
+    # Kept apart from the session file, which the editor routes rewrite wholesale
+    path = get_ai_draft_path(session_id)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(ai_draft, f)
+    os.replace(temp_path, path)
+
+def load_ai_draft(session_id):
+    try:
+        with open(get_ai_draft_path(session_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-\begin{{abstract}}
-This is an automatically generated research paper from the provided content.
-There was an error communicating with the AI service: {str(e)}
-\end{{abstract}}
+def start_ai_draft(session_id, text, title, model_name):
+    """Asks the LLM to structure the text in the background; the editor offers the result once it is ready."""
+    save_ai_draft(session_id, {'status': 'pending'})
 
-\section{{Content}}
-{escaped_fallback_text}
+    def run():
+        try:
+            latex_content = generate_research_paper_structure(text, title, model_name, fallback=False)
+            save_ai_draft(session_id, {'status': 'ready', 'latex_content': latex_content})
+            print(f"--- [AI draft] Ready for {session_id} ---", file=sys.stderr)
+        except Exception as e:
+            save_ai_draft(session_id, {'status': 'failed', 'error': str(e)})
 
-\end{{document}}"""
+    threading.Thread(target=run, daemon=True, name=f'ai-draft-{session_id}').start()
 
 def escape_latex(text):
     """Escapes LaTeX special characters in a given string, excluding backslash and braces.
@@ -207,6 +842,10 @@ def escape_latex(text):
 
     # Escape known special characters
     escaped_text = regex.sub(replace, text)
+    if escaped_text.isascii():
+        # Nothing for the filters below to drop. Offline structuring escapes every paragraph
+        # separately, and the character-by-character filter below dominated its run time
+        return escaped_text
 
     # Filter out remaining non-ASCII characters that might cause issues
     # Keep ASCII characters (0-127) and allow escaped sequences generated above
@@ -345,9 +984,8 @@ PLACEHOLDERS = {
     "item_start":       "__ITEMSTART__"     # New (no end needed for \item)
 }
 
-def modify_with_gemini(text, instruction):
+def modify_with_gemini(text, instruction, model_name=None):
     try:
-        model = genai.GenerativeModel(current_model)
         # Добавить проверку на простоту инструкции? Или всегда добавлять указание?
         # Пока добавим указание всегда:
         prompt = f"""
@@ -369,20 +1007,703 @@ def modify_with_gemini(text, instruction):
             max_output_tokens=8192
         )
 
-        response = model.generate_content(
-            prompt, 
-            generation_config=generation_config
-        )
+        response_text = generate_llm_text(prompt, model_name, generation_config)
         # Log the response from Gemini for debugging
         print("--- Gemini Response Start ---", file=sys.stderr)
-        print(response.text, file=sys.stderr)
+        print(response_text, file=sys.stderr)
         print("--- Gemini Response End ---", file=sys.stderr)
-        return response.text
+        return response_text
     except Exception as e:
         print(f"Error modifying content with Gemini: {e}", file=sys.stderr)
         return text
 
-def compile_latex_to_pdf(latex_content, output_dir):
+def limit_compile_resources(pid, niceness=0):
+    """Caps CPU, memory, file size and core dumps of a freshly spawned compile process.
+
+    Applied from the parent with prlimit right after spawn (preexec_fn is not safe in
+    a threaded server). Limits are clamped to the hard limits this server runs under,
+    since an unprivileged process cannot raise them.
+    """
+    cpu_seconds = COMPILE_CPU_SECONDS
+    memory_bytes = COMPILE_MEMORY_MB * 1024 * 1024
+    output_bytes = COMPILE_MAX_OUTPUT_MB * 1024 * 1024
+    # CPU: the soft limit sends SIGXCPU, the hard limit a few seconds later is a SIGKILL
+    limits = [(resource.RLIMIT_CPU, cpu_seconds, cpu_seconds + 5), (resource.RLIMIT_AS, memory_bytes, memory_bytes),
+              (resource.RLIMIT_FSIZE, output_bytes, output_bytes), (resource.RLIMIT_CORE, 0, 0)]
+    for limit, soft, hard in limits:
+        try:
+            _, current_hard = resource.prlimit(pid, limit)
+            if current_hard != resource.RLIM_INFINITY:
+                hard = min(hard, current_hard)
+                soft = min(soft, hard)
+            resource.prlimit(pid, limit, (soft, hard))
+        except (ValueError, OSError):
+            pass # Not enforceable here (e.g. RLIMIT_AS on some kernels), or the process already exited
+    if niceness:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, niceness)
+        except OSError:
+            pass
+
+def get_remaining_compile_time(results):
+    # One compile job (all its passes together) gets COMPILE_TIMEOUT_SECONDS of wall time
+    return COMPILE_TIMEOUT_SECONDS - sum(r['wall_time'] for r in results)
+
+def run_compile_command(cmd, cwd, timeout=None, niceness=0, on_spawn=None):
+    """Runs a TeX toolchain command (pdflatex, bibtex) under resource limits.
+
+    The command runs in its own process group with a wall-clock timeout; a runaway
+    job is killed together with anything it spawned. Callers running several passes
+    pass what is left of the job's budget (get_remaining_compile_time); with none
+    left nothing is spawned. pdflatex always gets -no-shell-escape. `niceness` lowers the CPU priority of the job and `on_spawn`
+    receives the Popen object, so callers can kill its process group early.
+    Returns a dict with returncode, output (tail of the combined stdout/stderr),
+    timed_out, wall_time and cpu_time.
+    """
+    timeout = COMPILE_TIMEOUT_SECONDS if timeout is None else timeout
+    cmd = list(cmd)
+    if cmd[0] == 'pdflatex' and '-no-shell-escape' not in cmd:
+        cmd.insert(1, '-no-shell-escape')
+    env = dict(os.environ, openout_any='p') # Paranoid: TeX may only write below cwd
+
+    start = time.monotonic()
+    if timeout <= 0:
+        return {'returncode': -1, 'output': 'Compile time limit exceeded before this pass', 'timed_out': True,
+                'wall_time': 0.0, 'cpu_time': 0.0}
+    if resource is None:
+        # No rlimits or process groups (Windows): fall back to a plain timeout
+        try:
+            result = subprocess.run(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, timeout=timeout)
+            returncode, output, timed_out = result.returncode, result.stdout, False
+        except subprocess.TimeoutExpired as e:
+            returncode, output, timed_out = -1, e.stdout or b'', True
+        return {
+            'returncode': returncode,
+            'output': output[-COMPILE_MAX_LOG_BYTES:].decode('utf-8', errors='ignore'),
+            'timed_out': timed_out,
+            'wall_time': round(time.monotonic() - start, 3),
+            'cpu_time': None,
+        }
+
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, start_new_session=True)
+    if hasattr(resource, 'prlimit'):
+        limit_compile_resources(proc.pid, niceness)
+    if on_spawn:
+        on_spawn(proc)
+    timed_out = threading.Event()
+
+    def kill_process_group():
+        timed_out.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(timeout, kill_process_group)
+    timer.daemon = True
+    timer.start()
+    try:
+        # Keep draining the pipe so the child never blocks, but only keep the tail (errors are at the end)
+        output = b''
+        for chunk in iter(lambda: proc.stdout.read(64 * 1024), b''):
+            output = (output + chunk)[-COMPILE_MAX_LOG_BYTES:]
+        proc.stdout.close()
+        # wait4 reaps the child and gives us its own rusage, unlike RUSAGE_CHILDREN which is process-wide
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        timer.cancel()
+        if proc.returncode is None:
+            kill_process_group()
+            proc.wait()
+
+    # Make sure nothing the job spawned outlives it
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+    return {
+        'returncode': proc.returncode,
+        'output': output.decode('utf-8', errors='ignore'),
+        'timed_out': timed_out.is_set(),
+        'wall_time': round(time.monotonic() - start, 3),
+        'cpu_time': round(usage.ru_utime + usage.ru_stime, 3),
+    }
+
+def summarize_compile_usage(results):
+    """Totals the resource usage of all passes of one compile job."""
+    return {
+        'passes': len(results),
+        'wall_time': round(sum(r['wall_time'] for r in results), 3),
+        'cpu_time': round(sum(r['cpu_time'] or 0 for r in results), 3),
+        'timed_out': any(r['timed_out'] for r in results),
+    }
+
+FILE_LINE_ERROR_RE = re.compile(r'^(?:\./)?([^\s:]+\.\w+):(\d+): (.*)$')
+TEX_ERROR_LINE_RE = re.compile(r'^l\.(\d+)')
+LATEX_WARNING_RE = re.compile(r'^((?:LaTeX|Package \w+|Class \w+) Warning: .*?)(?: on input line (\d+))?\.?$')
+
+def parse_latex_log(log_text):
+    """Extracts structured errors and warnings from pdflatex output.
+
+    Understands both the -file-line-error format ("./paper.tex:12: message") and
+    the classic "! message" ... "l.12 context" format.
+    Returns (errors, warnings), each a list of {'file', 'line', 'message'} dicts.
+    """
+    errors = []
+    warnings = []
+    lines = log_text.splitlines()
+    for i, line in enumerate(lines):
+        match = FILE_LINE_ERROR_RE.match(line)
+        if match:
+            errors.append({'file': match.group(1), 'line': int(match.group(2)), 'message': match.group(3).strip()})
+            continue
+        if line.startswith('! '):
+            line_number = None
+            for following in lines[i + 1:i + 10]:
+                line_match = TEX_ERROR_LINE_RE.match(following)
+                if line_match:
+                    line_number = int(line_match.group(1))
+                    break
+            errors.append({'file': 'paper.tex', 'line': line_number, 'message': line[2:].strip()})
+            continue
+        match = LATEX_WARNING_RE.match(line)
+        if match:
+            warnings.append({'file': 'paper.tex', 'line': int(match.group(2)) if match.group(2) else None, 'message': match.group(1)})
+
+    # pdflatex repeats itself across passes, keep the first occurrence of each diagnostic
+    def dedupe(items):
+        seen = set()
+        unique = []
+        for item in items:
+            key = (item['file'], item['line'], item['message'])
+            if key not in seen:
+                seen.add(key)
+                unique.append(item)
+        return unique
+
+    return dedupe(errors), dedupe(warnings)
+
+# Commands whose argument TeX reads verbatim, up to a closing delimiter of the writer's choice (or a {...} group)
+INLINE_VERBATIM_COMMAND = (r'\\(?:verb\*?|Verb\*?|lstinline(?:\[[^\]\n]*\])?'
+                           r'|mintinline(?:\[[^\]\n]*\])?\s*\{[^{}\n]*\})')
+PREFLIGHT_TOKEN_RE = re.compile(
+    r'\\(begin|end)\s*\{([^{}\n]*)\}'
+    r'|\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^{}\n]*)\}'
+    r'|' + INLINE_VERBATIM_COMMAND + r'([^a-zA-Z\s])'
+    r'|\\(iffalse)(?![a-zA-Z@])'
+    r'|\\(def|gdef|edef|xdef|newcommand|renewcommand|providecommand|DeclareRobustCommand'
+    r'|newenvironment|renewenvironment)(?![a-zA-Z@])'
+)
+ENVIRONMENT_TOKEN_RE = re.compile(r'\\(begin|end)\s*\{([^{}\n]*)\}')
+CONDITIONAL_RE = re.compile(r'\\(?:(fi)|if(?!thenelse)[a-zA-Z@]*)(?![a-zA-Z@])')
+DEFINITION_SCAN_RE = re.compile(r'\\[\\{}\[\]]|[{}\[\]]')
+BRACE_RE = re.compile(r'\\[\\{}]|[{}]')
+# Arguments TeX reads verbatim, where % is a literal character (URLs, \verb) and not a comment
+VERBATIM_ARGUMENT_RE = re.compile(r'\\(?:url|href|nolinkurl|path)\s*\{([^{}\n]*)\}'
+                                  r'|' + INLINE_VERBATIM_COMMAND + r'(?:\{([^{}\n]*)\}|([^a-zA-Z\s*{])([^\n]*?)\3)')
+GRAPHICSPATH_RE = re.compile(r'\\graphicspath\s*\{((?:\s*\{[^{}\n]*\})*)\s*\}')
+NON_BRACE_BYTES = bytes(b for b in range(256) if b not in b'{}')
+BRACE_DEPTH_DELTA = {ord('{'): 1, ord('}'): -1}
+VERBATIM_ENVIRONMENTS = {'verbatim', 'verbatim*', 'lstlisting', 'minted', 'comment', 'Verbatim'}
+GRAPHICS_EXTENSIONS = ('', '.pdf', '.png', '.jpg', '.jpeg', '.PDF', '.PNG', '.JPG', '.JPEG')
+PREFLIGHT_MAX_ERRORS = 50
+# Scans of recent revisions (the editor checks the same buffer on save and again on compile)
+PREFLIGHT_CACHE = OrderedDict()
+PREFLIGHT_CACHE_SIZE = 64
+preflight_cache_lock = threading.Lock()
+
+def preflight_latex(latex_content, search_dirs=()):
+    """Checks a LaTeX document for errors that would certainly break pdflatex.
+
+    Runs in linear time without spawning anything: unbalanced braces, unmatched
+    \\begin/\\end, missing \\begin{document}/\\end{document}, \\includegraphics of
+    files that do not exist in search_dirs, and leftover Markdown code fences.
+    Returns a list of {'file', 'line', 'message'} errors in the same shape as
+    parse_latex_log; any error means the document should not be compiled.
+    The scan of the source is cached per revision; image files are looked up on every call.
+    """
+    revision = content_hash(latex_content)
+    with preflight_cache_lock:
+        scan = PREFLIGHT_CACHE.get(revision)
+        if scan is not None:
+            PREFLIGHT_CACHE.move_to_end(revision)
+    if scan is None:
+        scan = scan_latex_source(latex_content)
+        with preflight_cache_lock:
+            PREFLIGHT_CACHE[revision] = scan
+            if len(PREFLIGHT_CACHE) > PREFLIGHT_CACHE_SIZE:
+                PREFLIGHT_CACHE.popitem(last=False)
+    errors, graphics, graphics_dirs = scan
+
+    # \includegraphics also looks in every \graphicspath directory, relative to each search dir
+    search_dirs = [os.path.join(d, path) for d in search_dirs for path in graphics_dirs]
+    missing = [{'file': 'paper.tex', 'line': line, 'message': f"Image file '{graphic}' not found", 'source': 'preflight'}
+               for line, graphic in graphics if not graphic_exists(graphic, search_dirs)]
+    if missing:
+        errors = sorted(errors + missing, key=lambda error: error['line'])[:PREFLIGHT_MAX_ERRORS]
+    return list(errors)
+
+def scan_latex_source(latex_content):
+    """The file-independent part of preflight_latex: returns (errors, graphics, graphics_dirs).
+
+    graphics lists the (line, name) of every \\includegraphics. Material TeX does not
+    read as code is skipped: verbatim environments and arguments, \\iffalse blocks and
+    macro bodies. When a macro opens or closes environments on its own, where they pair
+    up is only known after expansion, so \\begin/\\end are not matched at all.
+    """
+    errors = []
+    environment_errors = []
+    graphics = []
+    # All scanning happens on the comment-free text, which has the same line numbering
+    text = strip_latex_comments(latex_content)
+    graphics_dirs = [''] + [path for match in GRAPHICSPATH_RE.finditer(text)
+                            for path in re.findall(r'\{([^{}]*)\}', match.group(1))]
+
+    def add_error(position, message, found=errors):
+        if len(found) < PREFLIGHT_MAX_ERRORS:
+            # Line numbers are only computed for the few positions we report
+            found.append({'file': 'paper.tex', 'line': text.count('\n', 0, position) + 1, 'message': message, 'source': 'preflight'})
+
+    def add_environment_error(position, message):
+        add_error(position, message, environment_errors)
+
+    # Spans of text outside verbatim material, where braces count
+    code_spans = []
+    span_start = 0
+    env_stack = []
+    environments_verifiable = True
+    document_begun = False
+    document_ended = False
+    scan_end = len(text)
+    pos = 0
+    while True:
+        match = PREFLIGHT_TOKEN_RE.search(text, pos)
+        if not match:
+            break
+        pos = match.end()
+        kind, env, graphic, verb_delim, iffalse, definition = match.groups()
+
+        if kind == 'begin':
+            env = env.strip()
+            if env == 'document':
+                document_begun = True
+            env_stack.append((env, match.start()))
+            if env in VERBATIM_ENVIRONMENTS:
+                # Nothing inside a verbatim environment is LaTeX, jump straight to its end
+                code_spans.append((span_start, pos))
+                end_pos = text.find(f"\\end{{{env}}}", pos)
+                if end_pos == -1:
+                    add_environment_error(match.start(), f"\\begin{{{env}}} is never closed")
+                    env_stack.pop()
+                    pos = span_start = scan_end
+                    break
+                pos = span_start = end_pos
+        elif kind == 'end':
+            env = env.strip()
+            if env_stack and env_stack[-1][0] == env:
+                env_stack.pop()
+            elif any(open_env == env for open_env, _ in env_stack):
+                # Report every environment left open in between, then recover at the matching one
+                while env_stack[-1][0] != env:
+                    open_env, open_pos = env_stack.pop()
+                    add_environment_error(open_pos, f"\\begin{{{open_env}}} is closed by \\end{{{env}}} on line {text.count(chr(10), 0, match.start()) + 1}")
+                env_stack.pop()
+            else:
+                add_environment_error(match.start(), f"\\end{{{env}}} without matching \\begin{{{env}}}")
+            if env == 'document':
+                # TeX ignores everything after \end{document}
+                document_ended = True
+                scan_end = pos
+                break
+        elif graphic is not None:
+            graphic = graphic.strip()
+            if not graphic:
+                add_error(match.start(), "\\includegraphics with an empty file name")
+            else:
+                graphics.append((text.count('\n', 0, match.start()) + 1, graphic))
+        elif verb_delim is not None:
+            # \verb|...| may contain anything, skip to its closing delimiter on the same line
+            end_pos = text.find('}' if verb_delim == '{' else verb_delim, pos)
+            newline_pos = text.find('\n', pos)
+            if end_pos != -1 and (newline_pos == -1 or end_pos < newline_pos):
+                code_spans.append((span_start, match.start()))
+                pos = span_start = end_pos + 1
+        elif iffalse:
+            # TeX skips an \iffalse block unread (a common block comment), braces included
+            code_spans.append((span_start, match.start()))
+            pos = span_start = find_conditional_end(text, pos)
+        else:
+            # A macro body is only read where the macro is used; its braces still have to balance
+            pos = find_definition_end(text, pos, definition)
+            if environments_verifiable and not definition.endswith('environment'):
+                environments_verifiable = has_balanced_environments(text, match.end(), pos)
+    code_spans.append((span_start, scan_end))
+
+    check_brace_balance(text, code_spans, add_error)
+
+    # Markdown fences only appear at the start of a line
+    fence_pos = text.find('```', 0, scan_end)
+    while fence_pos != -1:
+        if fence_pos == 0 or text[fence_pos - 1] == '\n':
+            add_error(fence_pos, "Stray Markdown code fence (```) in the LaTeX source")
+        fence_pos = text.find('```', fence_pos + 3, scan_end)
+
+    for open_env, open_pos in env_stack:
+        if open_env == 'document':
+            continue # Reported below as a missing \end{document}
+        add_environment_error(open_pos, f"\\begin{{{open_env}}} is never closed")
+    if not document_begun:
+        add_error(0, "Missing \\begin{document}")
+    elif not document_ended:
+        add_environment_error(len(text), "Missing \\end{document}")
+
+    if environments_verifiable:
+        errors.extend(environment_errors)
+    errors.sort(key=lambda error: error['line'])
+    return errors[:PREFLIGHT_MAX_ERRORS], graphics, graphics_dirs
+
+def find_conditional_end(text, pos):
+    # Position after the \fi closing a conditional opened before pos; nested \if...\fi pairs are skipped
+    depth = 1
+    for match in CONDITIONAL_RE.finditer(text, pos):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return match.end()
+    return len(text)
+
+def find_definition_end(text, pos, command):
+    """Position after the last brace group of the macro definition whose command ends at pos.
+
+    \\def takes its name and parameters unbraced, \\newcommand its name braced or not,
+    \\newenvironment a braced name plus begin and end code. [...] options are skipped.
+    """
+    if command.endswith('environment'):
+        groups = 3
+    elif command.endswith('def'):
+        groups = 1
+    else:
+        groups = 2 if text[pos:pos + 32].lstrip(' \t\n*').startswith('{') else 1
+    depth = 0
+    in_option = False
+    for match in DEFINITION_SCAN_RE.finditer(text, pos):
+        token = match.group()
+        if len(token) == 2:
+            continue # Escaped \{, \}, \[ or \]
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth < 0:
+                return match.start() # Unbalanced, left to the brace check
+            if depth == 0 and not in_option:
+                groups -= 1
+                if groups == 0:
+                    return match.end()
+        elif depth == 0:
+            in_option = token == '['
+    return len(text)
+
+def has_balanced_environments(text, start, end):
+    env_stack = []
+    for match in ENVIRONMENT_TOKEN_RE.finditer(text, start, end):
+        kind, env = match.group(1), match.group(2).strip()
+        if kind == 'begin':
+            env_stack.append(env)
+        elif not env_stack or env_stack.pop() != env:
+            return False
+    return not env_stack
+
+def strip_latex_comments(text):
+    """Removes % comments up to (not including) the newline, so line numbers are unchanged.
+
+    A % inside a verbatim argument (\\url, \\href, \\verb, ...) is kept.
+    """
+    pieces = []
+    start = 0
+    percent_pos = text.find('%')
+    verbatim_spans = None
+    while percent_pos != -1:
+        # An odd number of backslashes before the % means it is an escaped \%
+        backslashes = 0
+        while percent_pos - backslashes > 0 and text[percent_pos - backslashes - 1] == '\\':
+            backslashes += 1
+        if backslashes % 2:
+            percent_pos = text.find('%', percent_pos + 1)
+            continue
+        if verbatim_spans is None:
+            # Only documents with comments pay for finding the verbatim arguments
+            verbatim_spans = [match.span(next(group for group in (1, 2, 4) if match.group(group) is not None))
+                              for match in VERBATIM_ARGUMENT_RE.finditer(text)]
+            verbatim_starts = [span_start for span_start, _ in verbatim_spans]
+        span_index = bisect.bisect_right(verbatim_starts, percent_pos) - 1
+        if span_index >= 0 and percent_pos < verbatim_spans[span_index][1]:
+            percent_pos = text.find('%', verbatim_spans[span_index][1])
+            continue
+        pieces.append(text[start:percent_pos])
+        start = text.find('\n', percent_pos)
+        if start == -1:
+            start = len(text)
+            break
+        percent_pos = text.find('%', start)
+    if not pieces:
+        return text
+    pieces.append(text[start:])
+    return ''.join(pieces)
+
+def check_brace_balance(text, code_spans, add_error):
+    """Reports unmatched '}' and unclosed '{' within the given (start, end) spans of text."""
+    # Fast path: drop escaped braces, reduce the rest to brace bytes and track the running depth in C
+    code = ''.join(text[start:end] for start, end in code_spans).encode('utf-8', errors='ignore')
+    code = code.replace(b'\\\\', b'').replace(b'\\{', b'').replace(b'\\}', b'')
+    braces = code.translate(None, NON_BRACE_BYTES)
+    if not braces:
+        return
+    balanced = braces.count(b'{') == braces.count(b'}')
+    if balanced and min(itertools.accumulate(map(BRACE_DEPTH_DELTA.__getitem__, braces))) >= 0:
+        return
+
+    # Slow path, only for unbalanced documents: walk the braces again to locate the culprits
+    open_braces = []
+    for start, end in code_spans:
+        for match in BRACE_RE.finditer(text, start, end):
+            if match.group() == '{':
+                open_braces.append(match.start())
+            elif match.group() == '}':
+                if open_braces:
+                    open_braces.pop()
+                else:
+                    add_error(match.start(), "Unmatched closing brace '}'")
+    for open_pos in open_braces[:PREFLIGHT_MAX_ERRORS]:
+        add_error(open_pos, "Unclosed brace '{'")
+
+def graphic_exists(graphic, search_dirs):
+    candidates = [graphic] if os.path.isabs(graphic) else [os.path.join(d, graphic) for d in search_dirs]
+    if not candidates:
+        return True # Nowhere to look, let pdflatex decide
+    return any(os.path.isfile(candidate + ext) for candidate in candidates for ext in GRAPHICS_EXTENSIONS)
+
+def get_pdflatex_passes(mode, count):
+    """Builds the pdflatex command for each of `count` passes in the given compile mode.
+
+    check: one -draftmode pass, no PDF is written.
+    draft: -draftmode for every pass except the last, which writes the PDF.
+    final: every pass writes the PDF (the historical behavior).
+    Every pass writes SyncTeX data (paper.synctex.gz) for the page preview.
+    """
+    base_cmd = ['pdflatex', '-interaction=nonstopmode', '-file-line-error', '-synctex=1']
+    if mode == 'check':
+        return [base_cmd + ['-draftmode', 'paper.tex']]
+    passes = []
+    for pass_index in range(count):
+        is_last = pass_index == count - 1
+        if mode == 'draft' and not is_last:
+            passes.append(base_cmd + ['-draftmode', 'paper.tex'])
+        else:
+            passes.append(base_cmd + ['paper.tex'])
+    return passes
+
+SECTION_LEVELS = {'part': 0, 'chapter': 1, 'section': 2, 'subsection': 3, 'subsubsection': 4, 'paragraph': 5}
+STRUCTURE_RE = re.compile(
+    r'\\(part|chapter|section|subsection|subsubsection|paragraph)\*?\s*(?:\[[^\]]*\])?\s*\{((?:[^{}]|\{[^{}]*\})*)\}'
+    r'|\\(begin|end)\s*\{([^{}]*)\}'
+    r'|\\label\s*\{([^{}]*)\}'
+    r'|\\(?:eq|auto|c|C|page|name)?ref\s*\{([^{}]*)\}'
+    r'|\\(?:no)?cite[a-zA-Z]*\*?\s*(?:\[[^\]]*\]\s*){0,2}\{([^{}]*)\}'
+    r'|\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^{}]*)\}'
+    r'|\\(?:bibliography|addbibresource)\s*(?:\[[^\]]*\])?\s*\{([^{}]*)\}'
+)
+# Parsed chunks are shared across sessions and revisions, keyed by a digest of the chunk text.
+# Bounded by entries and by the structural items they hold, so huge chunks cannot grow it without limit.
+DOCUMENT_CHUNK_CACHE = OrderedDict()
+DOCUMENT_CHUNK_CACHE_SIZE = 20000
+DOCUMENT_CHUNK_CACHE_MAX_ITEMS = 500000
+document_chunk_cache_items = 0
+DOCUMENT_INDEX_CACHE = OrderedDict()
+DOCUMENT_INDEX_CACHE_SIZE = 64
+document_index_lock = threading.Lock()
+
+def parse_document_chunk(chunk):
+    """Returns the structural items of one chunk as (kind, line_in_chunk, value) tuples."""
+    items = []
+    text = strip_latex_comments(chunk)
+    line = 0
+    last_pos = 0
+    for match in STRUCTURE_RE.finditer(text):
+        line += text.count('\n', last_pos, match.start())
+        last_pos = match.start()
+        section, title, env_cmd, env, label, ref, cite, graphic, bibliography = match.groups()
+        if section:
+            items.append(('section', line, (SECTION_LEVELS[section], ' '.join(title.split()))))
+        elif env_cmd:
+            items.append((env_cmd, line, env.strip()))
+        elif label is not None:
+            items.append(('label', line, label.strip()))
+        elif ref is not None:
+            items.extend(('ref', line, key.strip()) for key in ref.split(',') if key.strip())
+        elif cite is not None:
+            for key in cite.split(','):
+                key = key.strip()
+                if key == '*':
+                    items.append(('cite_all', line, None)) # \nocite{*}: every entry of the bibliography
+                elif key:
+                    items.append(('cite', line, key))
+        elif graphic is not None:
+            items.append(('graphic', line, graphic.strip()))
+        else:
+            items.extend(('bibliography', line, name.strip()) for name in bibliography.split(',') if name.strip())
+    return items
+
+def split_document_chunks(latex_content):
+    """Splits the source at blank lines; an edit usually touches only one or two chunks."""
+    return latex_content.split('\n\n')
+
+def build_document_index(latex_content):
+    """Builds the structural index of a LaTeX document.
+
+    Only chunks (blank-line separated blocks) not seen before are parsed, so after
+    an edit the cost is proportional to the changed region plus a cheap assembly.
+    Returns a dict with the outline (sections), environments, labels, refs,
+    citations, graphics and bibliography files; lookups by label or cite key are
+    plain dict accesses.
+    """
+    sections = []
+    environments = []
+    labels = {}
+    refs = {}
+    citations = {}
+    cite_all = False
+    graphics = []
+    bibliographies = []
+    env_stack = []
+    line_offset = 1
+    parsed_chunks = 0
+    global document_chunk_cache_items
+
+    for chunk in split_document_chunks(latex_content):
+        chunk_key = hashlib.blake2b(chunk.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+        with document_index_lock:
+            items = DOCUMENT_CHUNK_CACHE.get(chunk_key)
+            if items is not None:
+                DOCUMENT_CHUNK_CACHE.move_to_end(chunk_key)
+        if items is None:
+            items = parse_document_chunk(chunk)
+            parsed_chunks += 1
+            with document_index_lock:
+                if chunk_key not in DOCUMENT_CHUNK_CACHE:
+                    DOCUMENT_CHUNK_CACHE[chunk_key] = items
+                    document_chunk_cache_items += len(items)
+                while DOCUMENT_CHUNK_CACHE and (len(DOCUMENT_CHUNK_CACHE) > DOCUMENT_CHUNK_CACHE_SIZE
+                                                or document_chunk_cache_items > DOCUMENT_CHUNK_CACHE_MAX_ITEMS):
+                    document_chunk_cache_items -= len(DOCUMENT_CHUNK_CACHE.popitem(last=False)[1])
+
+        for kind, chunk_line, value in items:
+            line = line_offset + chunk_line
+            if kind == 'section':
+                level, title = value
+                sections.append({'level': level, 'title': title, 'line': line})
+            elif kind == 'begin':
+                env_stack.append({'name': value, 'line': line, 'end_line': None})
+            elif kind == 'end':
+                # Close the innermost matching environment, tolerate broken nesting
+                for open_index in range(len(env_stack) - 1, -1, -1):
+                    if env_stack[open_index]['name'] == value:
+                        env = env_stack.pop(open_index)
+                        env['end_line'] = line
+                        environments.append(env)
+                        break
+            elif kind == 'label':
+                labels.setdefault(value, line)
+                # A label right after a section heading names that section
+                if sections and sections[-1]['line'] >= line - 1 and 'label' not in sections[-1]:
+                    sections[-1]['label'] = value
+            elif kind == 'ref':
+                refs.setdefault(value, []).append(line)
+            elif kind == 'cite':
+                citations.setdefault(value, []).append(line)
+            elif kind == 'cite_all':
+                cite_all = True
+            elif kind == 'graphic':
+                graphics.append({'path': value, 'line': line})
+            elif kind == 'bibliography':
+                bibliographies.append(value)
+        line_offset += chunk.count('\n') + 2
+
+    environments.extend(env_stack) # Never closed
+    environments.sort(key=lambda env: env['line'])
+    return {
+        'sections': sections,
+        'environments': environments,
+        'labels': labels,
+        'refs': refs,
+        'citations': citations,
+        'cite_all': cite_all,
+        'graphics': graphics,
+        'bibliographies': bibliographies,
+        'undefined_refs': sorted(key for key in refs if key not in labels),
+        'parsed_chunks': parsed_chunks,
+    }
+
+def get_document_index(latex_content):
+    """Returns the (cached) structural index for this exact revision of a document."""
+    revision = content_hash(latex_content)
+    with document_index_lock:
+        index = DOCUMENT_INDEX_CACHE.get(revision)
+        if index is not None:
+            DOCUMENT_INDEX_CACHE.move_to_end(revision)
+            return index
+    index = build_document_index(latex_content)
+    index['revision'] = revision
+    with document_index_lock:
+        DOCUMENT_INDEX_CACHE[revision] = index
+        if len(DOCUMENT_INDEX_CACHE) > DOCUMENT_INDEX_CACHE_SIZE:
+            DOCUMENT_INDEX_CACHE.popitem(last=False)
+    return index
+
+def run_compile_job(compile_dir, latex_content, mode, niceness=0, on_spawn=None, before_pass=None):
+    """Runs every pass of one compile of compile_dir/paper.tex; all compile paths go through here.
+
+    Writes the .bib files the document names from the local bibliography library,
+    then runs pdflatex, bibtex and the extra pdflatex passes citations need. A check
+    compile is a single -draftmode pass without bibtex. All passes share one
+    COMPILE_TIMEOUT_SECONDS budget. niceness may be a callable, read before each
+    pass. before_pass is called before each pass and may return False to stop the job. Returns a dict with ok, aborted, timed_out, the
+    per-pass results and the combined log.
+    """
+    bib_files = get_bibliography_files(latex_content) if mode != 'check' else {}
+    for bib_name, bib_content in bib_files.items():
+        bib_path = os.path.join(compile_dir, bib_name)
+        os.makedirs(os.path.dirname(bib_path), exist_ok=True)
+        with open(bib_path, 'w', encoding='utf-8') as bib_file:
+            bib_file.write(bib_content)
+    # Intermediate passes can skip writing the PDF in draft mode
+    pdflatex_passes = get_pdflatex_passes(mode, 3 if bib_files else 2)
+    commands = pdflatex_passes[:1] + ([['bibtex', 'paper']] if bib_files else []) + pdflatex_passes[1:]
+
+    job = {'ok': False, 'aborted': False, 'timed_out': False, 'results': [], 'log': ''}
+    for cmd in commands:
+        if before_pass and not before_pass():
+            job['aborted'] = True
+            return job
+        result = run_compile_command(cmd, compile_dir, timeout=get_remaining_compile_time(job['results']),
+                                     niceness=niceness() if callable(niceness) else niceness, on_spawn=on_spawn)
+        job['results'].append(result)
+        job['log'] += result['output'] + "\n"
+        job['timed_out'] = result['timed_out']
+        if cmd[0] == 'bibtex' and not result['timed_out']:
+            # A failing bibtex only costs citations, the document still compiles
+            if result['returncode'] != 0:
+                print(f"BibTeX warning/error: {result['output'][-500:]}", file=sys.stderr)
+            continue
+        if result['timed_out'] or result['returncode'] != 0:
+            return job
+    job['ok'] = True
+    return job
+
+def compile_latex_to_pdf(latex_content, output_dir, session_id=None, mode='final'):
     if not HAS_LATEX:
         # Save the LaTeX content to a file and return None to indicate PDF generation failed
         # The content should already be escaped at this point.
@@ -392,6 +1713,12 @@ def compile_latex_to_pdf(latex_content, output_dir):
         print("LaTeX not found. Saved .tex content only.", file=sys.stderr)
         return None
     
+    search_dirs = [os.path.join(app.config['UPLOAD_FOLDER'], session_id)] if session_id else []
+    preflight_errors = preflight_latex(latex_content, search_dirs)
+    if preflight_errors:
+        print(f"LaTeX preflight failed, not compiling: {preflight_errors}", file=sys.stderr)
+        return None
+
     # Create unique ID for this compilation
     compilation_id = str(uuid.uuid4())
     temp_dir = os.path.join(output_dir, compilation_id)
@@ -404,110 +1731,1137 @@ def compile_latex_to_pdf(latex_content, output_dir):
         print(latex_content)
         print("--- End of paper.tex content ---")
         latex_file.write(latex_content) # Write the original, pre-escaped content
+    stage_session_images(session_id, temp_dir)
     
-    # Create bibliography file if references are detected
-    # Note: We might need to be careful if bib_content also needs escaping?
-    # Assuming bib_content is already properly formatted .bib data for now.
-    if "\\bibliography{references}" in latex_content or "\\addbibresource" in latex_content:
-        # Placeholder for bib generation logic - ensure it produces valid .bib
-        # bib_content = generate_bibliography_from_latex(latex_content) # Pass escaped content?
-        bib_file_path = os.path.join(temp_dir, "references.bib")
-        # Create an empty bib file for now if logic isn't implemented
-        # to avoid BibTeX errors if file is expected but missing.
-        if not os.path.exists(bib_file_path):
-             with open(bib_file_path, "w", encoding="utf-8") as bib_file:
-                 bib_file.write("% Empty bib file created by Flask app\n")
-    
-    # Change to the temp directory
-    original_dir = os.getcwd()
-    os.chdir(temp_dir)
-    
+    results = []
+    # A syntax check is a single draft pass, too cheap to be worth pausing or cancelling background compiles for
+    if mode != 'check':
+        begin_foreground_compile(session_id, content_hash(latex_content))
     try:
-        # Run pdflatex, bibtex, and pdflatex again for proper citations
-        subprocess.run(["pdflatex", "-interaction=nonstopmode", "paper.tex"], check=True)
-        
-        # Check if bib file exists before running bibtex
-        if os.path.exists(os.path.join(temp_dir, "references.bib")) and ("\\bibliography{references}" in latex_content or "\\addbibresource" in latex_content):
-            # Attempt to run bibtex, but catch errors if .aux is missing etc.
-            try:
-                subprocess.run(["bibtex", "paper"], check=True, capture_output=True, text=True)
-            except subprocess.CalledProcessError as bib_e:
-                print(f"BibTeX warning/error: {bib_e.stderr}", file=sys.stderr)
-                # Continue compilation even if bibtex fails, might just miss citations
-            subprocess.run(["pdflatex", "-interaction=nonstopmode", "paper.tex"], check=True)
-        
-        # Run one more time to resolve references
-        subprocess.run(["pdflatex", "-interaction=nonstopmode", "paper.tex"], check=True)
+        job = run_compile_job(temp_dir, latex_content, mode)
+        results = job['results']
+        if job['timed_out']:
+            print(f"LaTeX compilation timed out after {summarize_compile_usage(results)['wall_time']}s", file=sys.stderr)
         
         # Check if the PDF was created
         pdf_path = os.path.join(temp_dir, "paper.pdf")
-        if os.path.exists(pdf_path):
+        if job['ok'] and os.path.exists(pdf_path):
             return pdf_path
         else:
             return None
-    except subprocess.CalledProcessError as e:
-        print(f"LaTeX compilation error: {e}", file=sys.stderr)
+    finally:
+        if mode != 'check':
+            end_foreground_compile()
+        print(f"LaTeX compile usage: {summarize_compile_usage(results)}", file=sys.stderr)
+
+# --- Local bibliography library: .bib files indexed by key, DOI and title tokens ---
+BIB_ENTRY_START_RE = re.compile(r'@\s*([A-Za-z]+)\s*([{(])')
+BIB_DELIMITER_RE = re.compile(r'[{}()]')
+BIB_FIELD_NAME_RE = re.compile(r'\s*,?\s*([A-Za-z][\w\-:.]*)\s*=\s*')
+BIB_SKIPPED_TYPES = {'comment', 'preamble', 'string'}
+BIBLIOGRAPHY_INDEX_VERSION = 1
+
+def read_bib_value(text, start):
+    """Reads a field value ({...}, "..." or a bare word/number) at text[start]; returns (value, end)."""
+    if start >= len(text):
+        return '', start
+    if text[start] == '{':
+        depth = 0
+        for delimiter in re.finditer(r'[{}]', text[start:]):
+            depth += 1 if delimiter.group() == '{' else -1
+            if depth == 0:
+                end = start + delimiter.end()
+                return text[start + 1:end - 1], end
+        return text[start + 1:], len(text)
+    if text[start] == '"':
+        depth = 0
+        for index in range(start + 1, len(text)):
+            char = text[index]
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+            elif char == '"' and depth == 0 and text[index - 1] != '\\':
+                return text[start + 1:index], index + 1
+        return text[start + 1:], len(text)
+    end = text.find(',', start)
+    end = len(text) if end == -1 else end
+    return text[start:end].strip(), end
+
+def parse_bib_fields(text):
+    fields = {}
+    position = 0
+    while True:
+        match = BIB_FIELD_NAME_RE.match(text, position)
+        if not match:
+            return fields
+        value, position = read_bib_value(text, match.end())
+        fields[match.group(1).lower()] = ' '.join(value.split())
+
+def parse_bibtex(text):
+    """Splits BibTeX source into entries: dicts with key, type, fields and the raw entry text.
+
+    @comment, @preamble and @string blocks are skipped; an unterminated entry ends parsing.
+    """
+    entries = []
+    position = 0
+    while True:
+        match = BIB_ENTRY_START_RE.search(text, position)
+        if not match:
+            return entries
+        closing = '}' if match.group(2) == '{' else ')'
+        depth = 0
+        end = None
+        for delimiter in BIB_DELIMITER_RE.finditer(text, match.end()):
+            char = delimiter.group()
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                if depth == 0 and closing == '}':
+                    end = delimiter.end()
+                    break
+                depth -= 1
+            elif char == ')' and depth == 0 and closing == ')':
+                end = delimiter.end()
+                break
+        if end is None:
+            return entries
+        position = end
+        entry_type = match.group(1).lower()
+        if entry_type in BIB_SKIPPED_TYPES:
+            continue
+        key, _, body = text[match.end():end - 1].partition(',')
+        if key.strip():
+            entries.append({'key': key.strip(), 'type': entry_type, 'fields': parse_bib_fields(body),
+                            'raw': text[match.start():end]})
+
+def normalize_doi(doi):
+    doi = doi.strip().lower()
+    for prefix in ('https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/', 'doi:'):
+        if doi.startswith(prefix):
+            doi = doi[len(prefix):]
+    return doi.strip()
+
+def bib_title_tokens(title):
+    return sorted(set(tokenize_for_structure(title.replace('{', '').replace('}', ''))))
+
+def get_bibliography_sources():
+    """Current (mtime_ns, size) of every configured .bib file that exists, keyed by path."""
+    sources = {}
+    for path in BIBLIOGRAPHY_PATHS:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        sources[path] = [stat.st_mtime_ns, stat.st_size]
+    return sources
+
+def build_bibliography_index(sources):
+    entries = {}
+    dois = {}
+    title_tokens = {}
+    for path in sources:
+        try:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                bib_text = f.read()
+        except OSError as e:
+            print(f"Could not read bibliography {path}: {e}", file=sys.stderr)
+            continue
+        for entry in parse_bibtex(bib_text):
+            key = entry['key']
+            if key in entries:
+                continue # The first file listed wins
+            fields = entry['fields']
+            entries[key] = {
+                'type': entry['type'],
+                'title': fields.get('title', ''),
+                'author': fields.get('author', ''),
+                'year': fields.get('year', ''),
+                'doi': fields.get('doi', ''),
+                'raw': entry['raw'],
+            }
+            if fields.get('doi'):
+                dois.setdefault(normalize_doi(fields['doi']), key)
+            for token in bib_title_tokens(fields.get('title', '')):
+                title_tokens.setdefault(token, []).append(key)
+    return {'version': BIBLIOGRAPHY_INDEX_VERSION, 'sources': sources, 'entries': entries, 'doi': dois,
+            'title_tokens': title_tokens}
+
+def load_bibliography_index(sources):
+    """Reuses the on-disk index if it was built from exactly these files, otherwise rebuilds and stores it."""
+    try:
+        with open(BIBLIOGRAPHY_INDEX_PATH, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == BIBLIOGRAPHY_INDEX_VERSION and index.get('sources') == sources:
+            return index
+    except (OSError, ValueError):
+        pass
+    start = time.perf_counter()
+    index = build_bibliography_index(sources)
+    print(f"Indexed {len(index['entries'])} bibliography entries from {len(sources)} file(s) in {time.perf_counter() - start:.3f}s", file=sys.stderr)
+    try:
+        temp_path = f"{BIBLIOGRAPHY_INDEX_PATH}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_path, BIBLIOGRAPHY_INDEX_PATH)
+    except OSError as e:
+        print(f"Could not store bibliography index: {e}", file=sys.stderr)
+    return index
+
+bibliography_state = {'index': None, 'checked': 0.0}
+bibliography_lock = threading.Lock()
+
+def get_bibliography_index():
+    """The bibliography index, reloaded when a .bib file changes (checked at most every few seconds)."""
+    with bibliography_lock:
+        index = bibliography_state['index']
+        now = time.monotonic()
+        if index is not None and now - bibliography_state['checked'] < BIBLIOGRAPHY_CHECK_INTERVAL:
+            return index
+        bibliography_state['checked'] = now
+        sources = get_bibliography_sources()
+        if index is None or index['sources'] != sources:
+            index = load_bibliography_index(sources)
+            bibliography_state['index'] = index
+        return index
+
+def resolve_citations(citation_keys, include_all=False):
+    """Splits cite keys into ({key: raw BibTeX entry} found in the library, [keys not found]).
+
+    include_all (\\nocite{*}) adds every library entry to the hits.
+    """
+    entries = get_bibliography_index()['entries']
+    hits = {key: entry['raw'] for key, entry in entries.items()} if include_all else {}
+    missing = []
+    for key in citation_keys:
+        entry = entries.get(key)
+        if entry:
+            hits[key] = entry['raw']
+        else:
+            missing.append(key)
+    return hits, missing
+
+def search_bibliography(key=None, doi=None, title=None, limit=10):
+    """Library entries matching a key, a DOI, or the most words of a title."""
+    index = get_bibliography_index()
+    if key:
+        keys = [key] if key in index['entries'] else []
+    elif doi:
+        found = index['doi'].get(normalize_doi(doi))
+        keys = [found] if found else []
+    elif title:
+        scores = {}
+        for token in bib_title_tokens(title):
+            for match in index['title_tokens'].get(token, ()):
+                scores[match] = scores.get(match, 0) + 1
+        keys = sorted(scores, key=lambda match: (-scores[match], match))[:limit]
+    else:
+        keys = []
+    return [dict(index['entries'][match], key=match) for match in keys]
+
+def assemble_bibliography(hits, missing):
+    """references.bib content from library entries, noting the keys the library could not resolve."""
+    parts = list(hits.values())
+    if missing:
+        parts.append(f"% Not found in the local bibliography: {', '.join(missing)}")
+    return '\n\n'.join(parts) + '\n' if parts else "% Empty bib file created by Flask app\n"
+
+def get_bibliography_files(latex_content):
+    """The .bib files named by the document's \\bibliography, as {relative path: content}.
+
+    Entries cited by the document (every library entry with \\nocite{*}) go into the
+    first file, further files only get a comment, so BibTeX sees each entry once.
+    Names that would point outside the compile directory are ignored.
+    """
+    index = get_document_index(latex_content)
+    names = []
+    for name in index['bibliographies']:
+        name = os.path.normpath(name if name.endswith('.bib') else f"{name}.bib")
+        if os.path.isabs(name) or name.split(os.sep)[0] == '..' or name in names:
+            continue
+        names.append(name)
+    if not names:
+        return {}
+    hits, missing = resolve_citations(index['citations'], include_all=index['cite_all'])
+    files = {names[0]: assemble_bibliography(hits, missing)}
+    for name in names[1:]:
+        files[name] = f"% All entries are in {names[0]}\n"
+    return files
+
+def allowed_image(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
+
+def get_session_images_dir(session_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], session_id, 'images')
+
+def ingest_image(image_bytes, images_dir):
+    """Stores an uploaded image in images_dir in a pdflatex-friendly form.
+
+    Images are content-addressed by the SHA-256 of the uploaded bytes, so the same
+    image uploaded twice is only processed and stored once. PDFs are kept as-is,
+    rasters are downscaled to IMAGE_TARGET_DPI at full text width and normalized
+    to PNG (lossless sources, transparency) or JPEG (photos).
+    Returns (stored_filename, was_duplicate).
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()[:32]
+    os.makedirs(images_dir, exist_ok=True)
+
+    # Dedupe: any normalized variant of this exact upload is already good to use
+    for ext in ('png', 'jpg', 'pdf'):
+        existing_name = f"{digest}.{ext}"
+        if os.path.exists(os.path.join(images_dir, existing_name)):
+            return existing_name, True
+
+    if image_bytes[:5] == b'%PDF-':
+        # pdflatex embeds PDF graphics directly, nothing to normalize
+        stored_name = f"{digest}.pdf"
+        output_bytes = image_bytes
+    else:
+        img = Image.open(BytesIO(image_bytes))
+        source_format = img.format
+        max_size = (int(IMAGE_TARGET_DPI * IMAGE_TEXTWIDTH_INCHES), int(IMAGE_TARGET_DPI * IMAGE_TEXTHEIGHT_INCHES))
+
+        # Photos stay JPEG, everything lossless or with transparency becomes PNG
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        use_jpeg = not has_alpha and source_format in ('JPEG', 'MPO', 'WEBP')
+        # pdflatex ignores the EXIF Orientation tag, so rotated photos must be re-encoded upright
+        orientation = img.getexif().get(0x0112, 1)
+        width, height = (img.height, img.width) if orientation in (5, 6, 7, 8) else img.size
+        needs_resize = width > max_size[0] or height > max_size[1]
+
+        if not needs_resize and orientation == 1 and source_format == ('JPEG' if use_jpeg else 'PNG'):
+            # Already embeddable at a sane size: keep the original bytes, no re-encode
+            stored_name = f"{digest}.{'jpg' if use_jpeg else 'png'}"
+            output_bytes = image_bytes
+        else:
+            if source_format == 'JPEG':
+                # Let libjpeg do most of the scaling during decode (DCT scaling is much cheaper)
+                img.draft('RGB', max_size if (width, height) == img.size else max_size[::-1])
+            img = ImageOps.exif_transpose(img)
+            if needs_resize:
+                img.thumbnail(max_size, Image.LANCZOS)
+
+            buffer = BytesIO()
+            if use_jpeg:
+                if img.mode not in ('RGB', 'L', 'CMYK'):
+                    img = img.convert('RGB')
+                img.save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+                stored_name = f"{digest}.jpg"
+            else:
+                if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                    img = img.convert('RGBA' if has_alpha else 'RGB')
+                img.save(buffer, format='PNG', optimize=True)
+                stored_name = f"{digest}.png"
+            output_bytes = buffer.getvalue()
+
+    # Write atomically so concurrent uploads of the same image never see a partial file
+    stored_path = os.path.join(images_dir, stored_name)
+    temp_path = f"{stored_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(output_bytes)
+    os.replace(temp_path, stored_path)
+    return stored_name, False
+
+def stage_session_images(session_id, compile_dir):
+    """Makes the session's images/ directory visible inside a compile directory."""
+    if not session_id:
+        return
+    images_dir = get_session_images_dir(session_id)
+    target = os.path.join(compile_dir, 'images')
+    if not os.path.isdir(images_dir) or os.path.exists(target):
+        return
+    try:
+        os.symlink(images_dir, target, target_is_directory=True)
+    except OSError:
+        # Symlinks may be unavailable (e.g. Windows without privileges)
+        shutil.copytree(images_dir, target)
+
+def get_session_file_path(session_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], session_id, f"{session_id}_session.json")
+
+def load_session(session_id):
+    """Returns the stored session data, or None if the session does not exist."""
+    session_file_path = get_session_file_path(session_id)
+    if not session_id or not os.path.exists(session_file_path):
+        return None
+    with open(session_file_path, 'r') as f:
+        return json.load(f)
+
+def save_session(session_id, session_data):
+    # Write to a temp file and swap it in so readers never see a half-written session
+    session_file_path = get_session_file_path(session_id)
+    temp_path = f"{session_file_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(session_data, f, indent=4)
+    os.replace(temp_path, session_file_path)
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def send_bytes(data, mimetype, download_name, etag=None):
+    """Serves in-memory content as a download with a strong ETag.
+
+    Conditional GETs (If-None-Match) get a 304 without a body, so clients that
+    re-download unchanged files don't transfer them again.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    response = app.response_class(data, mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(etag or content_hash(data))
+    response.cache_control.no_cache = True # Always revalidate, the ETag makes that cheap
+    return response.make_conditional(request)
+
+def read_synctex(compile_dir):
+    synctex_path = os.path.join(compile_dir, 'paper.synctex.gz')
+    if not os.path.exists(synctex_path):
+        return None
+    with open(synctex_path, 'rb') as f:
+        return f.read()
+
+def store_session_pdf(session_id, pdf_bytes, latex_content, synctex_bytes=None):
+    """Keeps the latest compiled PDF (and its SyncTeX data) in the session so it can be re-downloaded without recompiling.
+
+    Only the build output and the hash of the source it came from are recorded;
+    saving the source itself is left to the editor routes.
+    """
+    session_data = load_session(session_id)
+    if session_data is None:
+        return
+    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    synctex_path = os.path.join(session_dir, 'paper.synctex.gz')
+    for path, data in ((os.path.join(session_dir, 'paper.pdf'), pdf_bytes), (synctex_path, synctex_bytes)):
+        if data is None:
+            continue
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    if synctex_bytes is None and os.path.exists(synctex_path):
+        os.remove(synctex_path) # Belongs to an older PDF
+    session_data['pdf_hash'] = content_hash(pdf_bytes)
+    session_data['pdf_source_hash'] = content_hash(latex_content)
+    save_session(session_id, session_data)
+
+# Speculative compiles: jobs per session (at most one, for its newest revision) and the number of
+# user-facing compiles in progress, which speculative jobs yield to. Both are guarded by compile_activity.
+speculative_jobs = {}
+foreground_compiles = 0
+compile_activity = threading.Condition()
+speculative_executor = ThreadPoolExecutor(max_workers=SPECULATIVE_COMPILE_WORKERS, thread_name_prefix='speculative-compile')
+
+def get_speculative_paths(session_id):
+    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    return (os.path.join(session_dir, 'speculative.pdf'), os.path.join(session_dir, 'speculative.json'),
+            os.path.join(session_dir, 'speculative.synctex.gz'))
+
+def store_speculative_result(session_id, source_hash, mode, pdf_bytes, usage, synctex_bytes=None):
+    """Keeps a speculative PDF on disk next to the session, so any worker can serve it."""
+    pdf_path, meta_path, synctex_path = get_speculative_paths(session_id)
+    synctex_bytes = synctex_bytes or b''
+    meta = {'source_hash': source_hash, 'mode': mode, 'pdf_hash': content_hash(pdf_bytes),
+            'synctex_hash': content_hash(synctex_bytes), 'usage': usage}
+    for path, data in ((pdf_path, pdf_bytes), (synctex_path, synctex_bytes), (meta_path, json.dumps(meta).encode('utf-8'))):
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+def load_speculative_result(session_id, source_hash, mode):
+    """Returns (pdf_bytes, usage, synctex_bytes) of a finished speculative compile of exactly this source, or None."""
+    pdf_path, meta_path, synctex_path = get_speculative_paths(session_id)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('source_hash') != source_hash or meta.get('mode') != mode:
+            return None
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+        with open(synctex_path, 'rb') as f:
+            synctex_bytes = f.read()
+    except (OSError, ValueError):
         return None
+    if content_hash(pdf_bytes) != meta.get('pdf_hash') or content_hash(synctex_bytes) != meta.get('synctex_hash'):
+        return None # Two jobs raced and the files belong to the other one
+    return pdf_bytes, meta.get('usage'), synctex_bytes or None
+
+def cancel_speculative_job(job):
+    job['cancelled'].set()
+    with compile_activity:
+        proc = job['proc']
+        compile_activity.notify_all() # Wake the job if it is waiting for foreground compiles
+    if proc is not None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def restore_compile_priority(proc):
+    # Undoes SPECULATIVE_COMPILE_NICENESS for a running pass; lowering niceness needs CAP_SYS_NICE (or RLIMIT_NICE)
+    if proc is None or resource is None:
+        return
+    try:
+        os.setpriority(os.PRIO_PGRP, proc.pid, 0)
+    except OSError as e:
+        print(f"--- [speculative compile] Could not restore priority of pid {proc.pid}: {e} ---", file=sys.stderr)
+
+def begin_foreground_compile(session_id, source_hash):
+    """Registers a user-facing compile. Speculative jobs pause between passes until it
+    has finished, and a speculative job for another revision of this session is cancelled."""
+    global foreground_compiles
+    with compile_activity:
+        foreground_compiles += 1
+        job = speculative_jobs.get(session_id)
+    if job and job['source_hash'] != source_hash:
+        cancel_speculative_job(job)
+
+def end_foreground_compile():
+    global foreground_compiles
+    with compile_activity:
+        foreground_compiles -= 1
+        compile_activity.notify_all()
+
+def schedule_speculative_compile(session_id, latex_content, mode=SPECULATIVE_COMPILE_MODE):
+    """Starts a low-priority background compile of a newly saved revision.
+
+    Any job still running for an older revision of the session is cancelled. Sources
+    that fail preflight are skipped; the user sees those errors when they compile.
+    """
+    if not SPECULATIVE_COMPILE_ENABLED or not HAS_LATEX or not latex_content:
+        return
+    source_hash = content_hash(latex_content)
+    if load_speculative_result(session_id, source_hash, mode):
+        return
+    if preflight_latex(latex_content, [os.path.join(app.config['UPLOAD_FOLDER'], session_id)]):
+        return
+
+    job = {'source_hash': source_hash, 'mode': mode, 'cancelled': threading.Event(), 'done': threading.Event(),
+           'started': False, 'promoted': False, 'proc': None, 'pdf_bytes': None, 'usage': None, 'synctex_bytes': None}
+    with compile_activity:
+        previous = speculative_jobs.get(session_id)
+        if previous and previous['source_hash'] == source_hash and previous['mode'] == mode:
+            return
+        speculative_jobs[session_id] = job
+    if previous:
+        cancel_speculative_job(previous)
+    print(f"--- [speculative compile] Queued {mode} compile of revision {source_hash[:12]} for {session_id} ---", file=sys.stderr)
+    speculative_executor.submit(run_speculative_compile, session_id, latex_content, job)
+
+def wait_for_foreground_idle(job):
+    """Blocks a speculative job while user-facing compiles run. Returns False once the job is cancelled."""
+    with compile_activity:
+        while foreground_compiles and not job['promoted'] and not job['cancelled'].is_set():
+            compile_activity.wait()
+    return not job['cancelled'].is_set()
+
+def is_superseded(session_id, job):
+    # Another worker may have saved a newer revision; a /compile waiting for this exact source keeps it alive
+    if job['promoted']:
+        return False
+    try:
+        session_data = load_session(session_id)
+    except ValueError:
+        return False # Caught the session file mid-write
+    return session_data is None or content_hash(session_data.get('latex_content', '')) != job['source_hash']
+
+def run_speculative_compile(session_id, latex_content, job):
+    temp_dir = None
+    results = []
+
+    def track_process(proc):
+        with compile_activity:
+            job['proc'] = proc
+            if job['promoted']:
+                restore_compile_priority(proc) # Promoted while this pass was being spawned
+
+    def get_niceness():
+        # Once a /compile waits for this job it is user-facing: remaining passes run at normal priority
+        return 0 if job['promoted'] else SPECULATIVE_COMPILE_NICENESS
+
+    try:
+        with compile_activity:
+            if job['cancelled'].is_set():
+                return
+            job['started'] = True
+        temp_dir = tempfile.mkdtemp()
+        with open(os.path.join(temp_dir, 'paper.tex'), 'w', encoding='utf-8') as f:
+            f.write(latex_content)
+        stage_session_images(session_id, temp_dir)
+
+        def before_pass():
+            # Yield to user-facing compiles between passes, stop once a newer revision exists
+            with compile_activity:
+                job['proc'] = None
+            return wait_for_foreground_idle(job) and not is_superseded(session_id, job)
+
+        # Same job as /compile, so the result is interchangeable with a foreground compile
+        compile_job = run_compile_job(temp_dir, latex_content, job['mode'], niceness=get_niceness,
+                                      on_spawn=track_process, before_pass=before_pass)
+        results = compile_job['results']
+        if compile_job['aborted'] or job['cancelled'].is_set():
+            print(f"--- [speculative compile] Cancelled revision {job['source_hash'][:12]} for {session_id} ---", file=sys.stderr)
+            return
+        if not compile_job['ok']:
+            print(f"--- [speculative compile] Compile of revision {job['source_hash'][:12]} failed for {session_id} ---", file=sys.stderr)
+            return
+
+        pdf_path = os.path.join(temp_dir, 'paper.pdf')
+        if not os.path.exists(pdf_path):
+            return
+        with open(pdf_path, 'rb') as pdf_file:
+            pdf_bytes = pdf_file.read()
+        usage = summarize_compile_usage(results)
+        synctex_bytes = read_synctex(temp_dir)
+        store_speculative_result(session_id, job['source_hash'], job['mode'], pdf_bytes, usage, synctex_bytes)
+        job['pdf_bytes'], job['usage'], job['synctex_bytes'] = pdf_bytes, usage, synctex_bytes
+        print(f"--- [speculative compile] Revision {job['source_hash'][:12]} ready for {session_id}: {usage} ---", file=sys.stderr)
+    except Exception as e:
+        print(f"--- [speculative compile] Error for {session_id}: {e} ---", file=sys.stderr)
     finally:
-        # Change back to the original directory
-        os.chdir(original_dir)
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        with compile_activity:
+            if speculative_jobs.get(session_id) is job:
+                del speculative_jobs[session_id]
+        job['done'].set()
+
+def take_speculative_result(session_id, latex_content, mode):
+    """Returns (pdf_bytes, usage, synctex_bytes) from a speculative compile of exactly this source, or None.
+
+    A job already running for this source is promoted and awaited: it stops yielding
+    to other compiles, its running pass is set back to normal priority and the remaining
+    passes start at normal priority. Resetting the running pass needs CAP_SYS_NICE; without
+    it that one pass finishes at SPECULATIVE_COMPILE_NICENESS. A job still queued behind
+    other sessions' jobs is cancelled instead, the caller compiles itself.
+    """
+    source_hash = content_hash(latex_content)
+    queued_job = None
+    with compile_activity:
+        job = speculative_jobs.get(session_id)
+        if job and job['source_hash'] == source_hash and job['mode'] == mode:
+            if job['started']:
+                job['promoted'] = True
+                restore_compile_priority(job['proc'])
+                compile_activity.notify_all()
+            else:
+                queued_job, job = job, None
+        else:
+            job = None
+    if queued_job:
+        cancel_speculative_job(queued_job)
+    if job:
+        # The job's passes share one COMPILE_TIMEOUT_SECONDS budget, so this wait is bounded by it
+        job['done'].wait(COMPILE_TIMEOUT_SECONDS + 5)
+        if job['pdf_bytes']:
+            return job['pdf_bytes'], job['usage'], job['synctex_bytes']
+    return load_speculative_result(session_id, source_hash, mode)
+
+# --- Page preview: SyncTeX maps editor lines to pages, pages are rendered one at a time ---
+# PNGs are named by the hash of the page's content, so a page that did not change between
+# revisions keeps its image and only changed pages are rendered again.
+SYNCTEX_INPUT_RE = re.compile(rb'^Input:(\d+):(.*)$', re.MULTILINE)
+SYNCTEX_RECORD_RE = re.compile(rb'^(?:\{(\d+)$|[\[(hvxkg$](\d+),(\d+)[:,])', re.MULTILINE)
+
+def parse_synctex_pages(synctex_bytes):
+    """Maps lines of paper.tex to the first page showing them: (sorted lines, their pages)."""
+    data = gzip.decompress(synctex_bytes)
+    tags = {match.group(1) for match in SYNCTEX_INPUT_RE.finditer(data)
+            if os.path.basename(match.group(2).strip()) == b'paper.tex'}
+    first_page = {}
+    page = 1
+    for match in SYNCTEX_RECORD_RE.finditer(data):
+        if match.group(1):
+            page = int(match.group(1))
+        elif match.group(2) in tags:
+            first_page.setdefault(int(match.group(3)), page) # Pages only go up, the first one seen is the lowest
+    lines = sorted(first_page)
+    return lines, [first_page[line] for line in lines]
+
+def find_page_for_line(build, line):
+    # The closest line at or above this one that produced output; the preamble maps to page 1
+    index = bisect.bisect_right(build['lines'], line) - 1
+    return build['pages'][index] if index >= 0 else 1
+
+def hash_pdf_pages(pdf_bytes):
+    """Content hash per page: its content stream, size and the images/forms it draws."""
+    reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
+    hashes = []
+    for page in reader.pages:
+        digest = hashlib.sha256(repr(list(page.mediabox)).encode('utf-8'))
+        contents = page.get_contents()
+        if contents is not None:
+            digest.update(contents.get_data())
+        resources = page.get('/Resources')
+        xobjects = resources.get_object().get('/XObject') if resources is not None else None
+        if xobjects is not None:
+            for name, reference in sorted(xobjects.get_object().items()):
+                digest.update(name.encode('utf-8'))
+                digest.update(reference.get_object().get_data())
+        hashes.append(digest.hexdigest())
+    return hashes
+
+def get_preview_dir(session_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], session_id, 'preview')
+
+def load_preview_build(session_id):
+    try:
+        with open(os.path.join(get_preview_dir(session_id), 'build.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def compile_for_preview(session_id, latex_content):
+    """Compiles like /compile (final mode). Returns (pdf_bytes, synctex_bytes, errors).
 
-def generate_bibliography_from_latex(latex_content):
+    Previews are background traffic: they neither register as a user-facing compile
+    (which would pause or cancel the session's speculative job) nor touch the session.
+    """
+    errors = preflight_latex(latex_content, [os.path.join(app.config['UPLOAD_FOLDER'], session_id)])
+    if errors:
+        return None, None, errors
+    temp_dir = tempfile.mkdtemp()
     try:
-        model = genai.GenerativeModel(current_model)
-        
-        # Extract citation commands
-        citation_pattern = r'\\cite\{([^}]+)\}'
-        citations = re.findall(citation_pattern, latex_content)
-        
-        # Flatten and make unique
-        citation_keys = []
-        for cite in citations:
-            for key in cite.split(','):
-                citation_keys.append(key.strip())
-        
-        citation_keys = list(set(citation_keys))
-        
-        if not citation_keys:
-            # Default bibliography with sample entries
-            return """
-    @article{sample1,
-    title={Sample Article Title},
-    author={Author, A. and Author, B.},
-    journal={Journal of Examples},
-    volume={1},
-    number={1},
-    pages={1--10},
-    year={2025}
-    }
+        with open(os.path.join(temp_dir, 'paper.tex'), 'w', encoding='utf-8') as f:
+            f.write(latex_content)
+        stage_session_images(session_id, temp_dir)
+        job = run_compile_job(temp_dir, latex_content, 'final')
+        if not job['ok']:
+            errors, _ = parse_latex_log(job['log'])
+            return None, None, errors or [{'file': None, 'line': None, 'message': 'LaTeX compilation failed'}]
+        pdf_path = os.path.join(temp_dir, 'paper.pdf')
+        if not os.path.exists(pdf_path):
+            return None, None, [{'file': None, 'line': None, 'message': 'No PDF was produced'}]
+        with open(pdf_path, 'rb') as f:
+            return f.read(), read_synctex(temp_dir), []
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-    @book{sample2,
-    title={Sample Book Title},
-    author={Author, C.},
-    publisher={Sample Publisher},
-    year={2024},
-    address={City, Country}
-    }
+def get_preview_build(session_id, latex_content):
+    """Returns (build, errors) for this exact source, compiling only when no PDF with SyncTeX exists for it.
+
+    A build records the revision, the PDF it was made from, the content hash of
+    every page and the SyncTeX line-to-page map. Images of pages whose hash is no
+    longer part of the build are removed. The editor buffer being previewed is not
+    saved: builds live in the preview directory only, and finished PDFs of the saved
+    or speculatively compiled revision are only read.
     """
-        
-        prompt = f"""
-        Generate a BibTeX bibliography (.bib file) for the following citation keys found in a LaTeX document:
-        {', '.join(citation_keys)}
-        
-        Create realistic and academic-appropriate BibTeX entries for each citation key. Make up appropriate information for each entry.
-        Format your response as valid BibTeX content only, no explanations.
-        """
-        
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        print(f"Error generating bibliography with Gemini: {e}", file=sys.stderr)
-        # Return a basic bibliography
-        return "\n".join([f"@article{{{key},\n  title={{Reference for {key}}},\n  author={{Author}},\n  journal={{Journal}},\n  year={{2025}}\n}}" for key in citation_keys])
+    revision = content_hash(latex_content)
+    build = load_preview_build(session_id)
+    if build and build['revision'] == revision:
+        return build, []
+
+    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    session_data = load_session(session_id) or {}
+    synctex_path = os.path.join(session_dir, 'paper.synctex.gz')
+    pdf_bytes = synctex_bytes = None
+    if session_data.get('pdf_source_hash') == revision and os.path.exists(synctex_path):
+        # The last compile (or a speculative one it adopted) already is this revision
+        with open(os.path.join(session_dir, 'paper.pdf'), 'rb') as f:
+            pdf_bytes = f.read()
+        with open(synctex_path, 'rb') as f:
+            synctex_bytes = f.read()
+    else:
+        # A finished speculative compile is reused; a running one is left alone instead of being promoted
+        speculative = load_speculative_result(session_id, revision, SPECULATIVE_COMPILE_MODE)
+        if speculative and speculative[2]:
+            pdf_bytes, _, synctex_bytes = speculative
+        else:
+            pdf_bytes, synctex_bytes, errors = compile_for_preview(session_id, latex_content)
+            if pdf_bytes is None:
+                return None, errors
+
+    lines, pages = parse_synctex_pages(synctex_bytes) if synctex_bytes else ([], [])
+    pdf_name = f"{content_hash(pdf_bytes)}.pdf"
+    build = {'revision': revision, 'pdf': pdf_name, 'page_hashes': hash_pdf_pages(pdf_bytes),
+             'lines': lines, 'pages': pages}
+
+    preview_dir = get_preview_dir(session_id)
+    os.makedirs(preview_dir, exist_ok=True)
+    for name, data in ((pdf_name, pdf_bytes), ('build.json', json.dumps(build).encode('utf-8'))):
+        temp_path = os.path.join(preview_dir, f"{name}.{uuid.uuid4().hex}.tmp")
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, os.path.join(preview_dir, name))
+    current_pages = set(build['page_hashes'])
+    for name in os.listdir(preview_dir):
+        stale_pdf = name.endswith('.pdf') and name != pdf_name
+        stale_page = name.endswith('.png') and name.split('_', 1)[0] not in current_pages
+        if stale_pdf or stale_page:
+            try:
+                os.remove(os.path.join(preview_dir, name))
+            except OSError:
+                pass
+    return build, []
+
+def render_preview_page(session_id, build, page_number, dpi):
+    """Path of the PNG for one page of the build at `dpi`, rendering it with pdftoppm if not cached."""
+    preview_dir = get_preview_dir(session_id)
+    png_path = os.path.join(preview_dir, f"{build['page_hashes'][page_number - 1]}_{dpi}.png")
+    if os.path.exists(png_path):
+        return png_path
+    output_prefix = os.path.join(preview_dir, f"render-{uuid.uuid4().hex}")
+    cmd = ['pdftoppm', '-f', str(page_number), '-l', str(page_number), '-r', str(dpi), '-png', '-singlefile',
+           build['pdf'], output_prefix]
+    result = run_compile_command(cmd, preview_dir, timeout=PREVIEW_RENDER_TIMEOUT)
+    if result['returncode'] != 0 or not os.path.exists(f"{output_prefix}.png"):
+        print(f"--- [preview] Rendering page {page_number} failed for {session_id}: {result['output'][-500:]} ---", file=sys.stderr)
+        return None
+    os.replace(f"{output_prefix}.png", png_path)
+    return png_path
+
+class ZipStreamBuffer:
+    """Write-only file object used to stream a zip archive as it is being built.
+
+    It has no tell()/seek(), so zipfile falls back to data descriptors and never
+    needs to rewind; the response generator drains the buffer after each write.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def get_bundle_members(session_id, session_data):
+    """Lists (archive_name, source, compress) for a session's project bundle.
+
+    source is either in-memory bytes or a path that is read lazily while streaming.
+    """
+    session_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    latex_content = session_data.get('latex_content', '')
+    members = [('paper.tex', latex_content.encode('utf-8'), True)]
+
+    # The same .bib files a compile writes, from the local bibliography library
+    for bib_name, bib_content in get_bibliography_files(latex_content).items():
+        members.append((bib_name.replace(os.sep, '/'), bib_content.encode('utf-8'), True))
+
+    images_dir = get_session_images_dir(session_id)
+    if os.path.isdir(images_dir):
+        for image_name in sorted(os.listdir(images_dir)):
+            if image_name.endswith('.tmp'):
+                continue
+            # Images are already compressed, deflating them again only costs CPU
+            members.append((f"images/{image_name}", os.path.join(images_dir, image_name), False))
+
+    # Only ship the PDF if it was compiled from the source we are bundling
+    pdf_path = os.path.join(session_dir, 'paper.pdf')
+    if os.path.exists(pdf_path) and session_data.get('pdf_source_hash') == content_hash(latex_content):
+        members.append(('paper.pdf', pdf_path, False))
+    return members
+
+def get_bundle_etag(members):
+    digest = hashlib.sha256()
+    for archive_name, source, _ in members:
+        digest.update(archive_name.encode('utf-8'))
+        if isinstance(source, bytes):
+            digest.update(content_hash(source).encode('ascii'))
+        else:
+            stat = os.stat(source)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode('ascii'))
+    return digest.hexdigest()
+
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0) # Earliest timestamp a zip entry can hold
+
+def get_zip_date_time(source):
+    # Entries are stamped from what the ETag covers, so equal ETags always mean equal bytes
+    if isinstance(source, bytes):
+        return ZIP_EPOCH
+    return max(ZIP_EPOCH, time.gmtime(os.stat(source).st_mtime)[:6])
+
+def stream_zip(members, chunk_size=64 * 1024):
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for archive_name, source, compress in members:
+            compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            info = zipfile.ZipInfo(archive_name, date_time=get_zip_date_time(source))
+            info.compress_type = compress_type
+            with archive.open(info, 'w') as entry:
+                if isinstance(source, bytes):
+                    entry.write(source)
+                else:
+                    with open(source, 'rb') as f:
+                        for chunk in iter(lambda: f.read(chunk_size), b''):
+                            entry.write(chunk)
+                            yield buffer.drain()
+            yield buffer.drain()
+    # Central directory is written on close
+    yield buffer.drain()
+
+class AdmissionPool:
+    """Concurrency limit with a bounded FIFO wait queue for one group of routes.
+
+    A request either runs at once, waits in the queue for a slot handed over by a
+    finishing request, or is rejected: when the queue is full, when it waited longer
+    than ADMISSION_QUEUE_TIMEOUT, or when its client already holds its budget.
+    """
+    def __init__(self, name, concurrency, queue_size, per_client):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.per_client = per_client
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiters = deque()
+        self.client_load = {}
+        self.service_time = 1.0 # Moving average of request duration, for Retry-After
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected_queue_full': 0, 'rejected_client_budget': 0,
+                      'rejected_queue_timeout': 0}
+
+    def acquire(self, client, timeout):
+        """Returns None once admitted, otherwise the rejection reason."""
+        with self.lock:
+            if self.client_load.get(client, 0) >= self.per_client:
+                self.stats['rejected_client_budget'] += 1
+                return 'client_budget'
+            if self.active < self.concurrency and not self.waiters:
+                self.active += 1
+                self.client_load[client] = self.client_load.get(client, 0) + 1
+                self.stats['admitted'] += 1
+                return None
+            if len(self.waiters) >= self.queue_size:
+                self.stats['rejected_queue_full'] += 1
+                return 'queue_full'
+            slot = threading.Event()
+            self.waiters.append(slot)
+            self.client_load[client] = self.client_load.get(client, 0) + 1
+            self.stats['queued'] += 1
+        if slot.wait(timeout):
+            return None
+        with self.lock:
+            if slot.is_set():
+                return None # Handed a slot just as the wait ran out
+            self.waiters.remove(slot)
+            self.release_client(client)
+            self.stats['rejected_queue_timeout'] += 1
+            return 'queue_timeout'
+
+    def release(self, client, duration):
+        with self.lock:
+            self.release_client(client)
+            self.service_time = 0.9 * self.service_time + 0.1 * duration
+            if self.waiters:
+                # Hand the slot straight to the longest waiting request
+                self.waiters.popleft().set()
+                self.stats['admitted'] += 1
+            else:
+                self.active -= 1
+
+    def release_client(self, client):
+        load = self.client_load.get(client, 0) - 1
+        if load > 0:
+            self.client_load[client] = load
+        else:
+            self.client_load.pop(client, None)
+
+    def retry_after(self):
+        # Time for the queue ahead to drain at the current service rate
+        with self.lock:
+            backlog = len(self.waiters) + 1
+        return max(1, math.ceil(self.service_time * backlog / self.concurrency))
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, active=self.active, queue_depth=len(self.waiters),
+                        concurrency=self.concurrency, queue_size=self.queue_size, per_client=self.per_client,
+                        avg_service_seconds=round(self.service_time, 3))
+
+admission_pools = {pool: AdmissionPool(pool, *limits) for pool, limits in ADMISSION_LIMITS.items()}
+
+def get_admission_pool():
+    """Picks the pool for the current request: expensive routes get their own, everything else is cheap."""
+    endpoint = request.endpoint
+    if endpoint in ('upload_file', 'upload_image'):
+        return 'upload'
+    if endpoint == 'api_preview' or (endpoint == 'compile_latex_route' and request.form.get('mode') == 'check'):
+        return 'background'
+    if endpoint == 'compile_latex_route':
+        return 'compile'
+    if endpoint == 'api_modify_latex':
+        return 'llm'
+    if endpoint == 'edit_paper' and request.method == 'POST':
+        if request.form.get('instruction'):
+            return 'llm'
+        if 'compile_pdf' in request.form:
+            return 'compile'
+    return 'cheap'
+
+def get_admission_client():
+    if ADMISSION_CLIENT_KEY == 'session':
+        session_id = (request.view_args or {}).get('session_id')
+        if not session_id and request.is_json:
+            session_id = (request.get_json(silent=True) or {}).get('session_id')
+        if not session_id:
+            session_id = request.form.get('session_id') # /upload_image sends it as a multipart field
+        if session_id:
+            return f"session:{session_id}"
+    forwarded = request.headers.get('X-Forwarded-For', '') if ADMISSION_TRUST_FORWARDED else ''
+    return f"ip:{forwarded.split(',')[0].strip() or request.remote_addr}"
+
+@app.before_request
+def admit_request():
+    if not ADMISSION_ENABLED or request.endpoint in (None, 'static'):
+        return None
+    pool = admission_pools[get_admission_pool()]
+    client = get_admission_client()
+    rejection = pool.acquire(client, ADMISSION_QUEUE_TIMEOUT)
+    if rejection:
+        retry_after = pool.retry_after()
+        print(f"--- [admission] Rejected {request.method} {request.path} from {client} ({pool.name}: {rejection}) ---", file=sys.stderr)
+        response = jsonify({'error': 'Server is busy, please retry later', 'reason': rejection, 'pool': pool.name,
+                            'retry_after': retry_after})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    g.admission = (pool, client, time.monotonic())
+    return None
+
+@app.teardown_request
+def release_admission(exc=None):
+    admission = g.pop('admission', None)
+    if admission:
+        pool, client, start = admission
+        pool.release(client, time.monotonic() - start)
+
+def is_profile_authorized():
+    token = request.headers.get('X-Profile-Token', '')
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+
+class StackSampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval into collapsed-stack counts.
+
+    The output ('outer;inner;leaf count' per line) is what flamegraph.pl and
+    speedscope read.
+    """
+    def __init__(self, thread_id, interval=PROFILE_STACK_INTERVAL):
+        super().__init__(daemon=True, name='profile-sampler')
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                # Parent directory too: flask/app.py and our app.py must stay apart
+                location = '/'.join(code.co_filename.replace(os.sep, '/').rsplit('/', 2)[-2:])
+                names.append(f"{code.co_name} ({location}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+# Since Python 3.12 cProfile hooks into sys.monitoring, which allows one active profiler per process
+profiler_slot = threading.Lock() if sys.version_info >= (3, 12) else None
+
+def start_request_profile():
+    if request.endpoint in (None, 'static') or request.endpoint.startswith('admin_'):
+        return
+    if is_profile_authorized():
+        trigger = 'header'
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        trigger = 'sampled'
+    else:
+        return
+    if profiler_slot is not None and not profiler_slot.acquire(blocking=False):
+        print(f"--- [profile] Skipped {request.method} {request.path}: another request is being profiled ---", file=sys.stderr)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiling tool (e.g. a debugger) is active; serve the request unprofiled
+        if profiler_slot is not None:
+            profiler_slot.release()
+        print(f"--- [profile] Skipped {request.method} {request.path}: {e} ---", file=sys.stderr)
+        return
+    sampler = StackSampler(threading.get_ident())
+    g.profile = {'id': uuid.uuid4().hex, 'trigger': trigger, 'profiler': profiler, 'sampler': sampler,
+                 'start': time.perf_counter()}
+    sampler.start()
+
+def finish_request_profile(status):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    profile['profiler'].disable()
+    if profiler_slot is not None:
+        profiler_slot.release()
+    collapsed = profile['sampler'].stop()
+    duration = time.perf_counter() - profile['start']
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base_path = os.path.join(PROFILE_DIR, profile['id'])
+        profile['profiler'].dump_stats(f"{base_path}.pstats")
+        with open(f"{base_path}.collapsed", 'w') as f:
+            f.write(collapsed)
+        meta = {'id': profile['id'], 'method': request.method, 'path': request.path, 'endpoint': request.endpoint,
+                'status': status, 'duration': round(duration, 4), 'trigger': profile['trigger'],
+                'created': round(time.time(), 3)}
+        with open(f"{base_path}.json", 'w') as f:
+            json.dump(meta, f)
+        prune_profiles()
+        print(f"--- [profile] Stored profile {profile['id']} for {request.method} {request.path} ({duration:.3f}s) ---", file=sys.stderr)
+    except OSError as e:
+        print(f"--- [profile] Could not store profile: {e} ---", file=sys.stderr)
+    return profile['id']
+
+def profile_response(response):
+    profile_id = finish_request_profile(response.status_code)
+    if profile_id:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+def profile_teardown(exc=None):
+    # Requests that raised never reach after_request
+    if 'profile' in g:
+        finish_request_profile(500)
+
+def list_profiles():
+    profiles = []
+    for name in os.listdir(PROFILE_DIR) if os.path.isdir(PROFILE_DIR) else ():
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(PROFILE_DIR, name), 'r') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return sorted(profiles, key=lambda meta: meta['created'], reverse=True)
+
+def prune_profiles():
+    for meta in list_profiles()[PROFILE_MAX_STORED:]:
+        for extension in ('json', 'pstats', 'collapsed'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, f"{meta['id']}.{extension}"))
+            except OSError:
+                pass
+
+if PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    # Registered after admission control, so time spent queueing is not profiled
+    app.before_request(start_request_profile)
+    app.after_request(profile_response)
+    app.teardown_request(profile_teardown)
 
 @app.route('/')
 def index():
-    return render_template('index.html', models=models, current_model=current_model, has_latex=HAS_LATEX)
+    return render_template('index.html', models=models, current_model=get_current_model(), has_latex=HAS_LATEX)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -585,6 +2939,11 @@ def upload_file():
             body=final_body_text # Body is already escaped and finalized
         )
 
+        # Optionally arrange the text into paper sections: instantly offline, then refined by the LLM if asked
+        structure = request.form.get('structure', 'none')
+        if structure in ('sections', 'ai'):
+            latex_content = structure_paper_locally(extracted_text, title, authors)
+
         # --- Save session data --- 
         session_data = {
             'latex_path': file_path,
@@ -594,10 +2953,10 @@ def upload_file():
         
         # In a real application, we would store this in a database or session
         # For simplicity, we're storing it in a file
-        session_file = os.path.join(session_dir, f"{session_id}_session.json")
-        import json
-        with open(session_file, 'w') as f:
-            json.dump(session_data, f)
+        save_session(session_id, session_data)
+        if structure == 'ai':
+            start_ai_draft(session_id, extracted_text, title, get_current_model())
+        schedule_speculative_compile(session_id, latex_content)
         
         return redirect(url_for('edit_paper', session_id=session_id))
     
@@ -629,24 +2988,37 @@ def edit_paper(session_id):
         
         # Update the session data
         session_data['latex_content'] = latex_content
-        with open(session_file_path, 'w') as f:
-            json.dump(session_data, f)
+        save_session(session_id, session_data)
         
         # Compile to PDF if requested
-        if 'compile_pdf' in request.form:
+        if 'compile_pdf' not in request.form:
+            schedule_speculative_compile(session_id, latex_content)
+        else:
             if not HAS_LATEX:
                 flash('LaTeX (pdflatex) is not installed. Please install LaTeX to generate PDFs.', 'error')
                 return render_template('edit.html', 
                                      session_id=session_id, 
                                      latex_content=session_data['latex_content'],
                                      models=models,
-                                     current_model=current_model,
+                                     current_model=get_current_model(),
                                      has_latex=HAS_LATEX)
             
-            pdf_path = compile_latex_to_pdf(latex_content, app.config['UPLOAD_FOLDER'])
+            mode = 'draft' if request.form.get('mode') == 'draft' else 'final'
+            # Show preflight diagnostics to the user instead of a generic compile error
+            preflight_errors = preflight_latex(latex_content, [os.path.join(app.config['UPLOAD_FOLDER'], session_id)])
+            for error in preflight_errors[:5]:
+                flash(f"Line {error['line']}: {error['message']}", 'error')
+
+            pdf_path = None if preflight_errors else compile_latex_to_pdf(latex_content, app.config['UPLOAD_FOLDER'], session_id, mode)
             if pdf_path:
-                return send_file(pdf_path, as_attachment=True, download_name='research_paper.pdf')
-            else:
+                with open(pdf_path, 'rb') as pdf_file:
+                    pdf_bytes = pdf_file.read()
+                synctex_bytes = read_synctex(os.path.dirname(pdf_path))
+                # The compile directory is no longer needed once the PDF is in memory
+                shutil.rmtree(os.path.dirname(pdf_path), ignore_errors=True)
+                store_session_pdf(session_id, pdf_bytes, latex_content, synctex_bytes)
+                return send_bytes(pdf_bytes, 'application/pdf', 'research_paper.pdf')
+            elif not preflight_errors:
                 flash('Error compiling LaTeX to PDF')
     
     # GET request: Load existing data
@@ -658,12 +3030,15 @@ def edit_paper(session_id):
         flash('Session expired or invalid.')
         return redirect(url_for('index'))
     
+    ai_draft = load_ai_draft(session_id)
     return render_template('edit.html', 
                           session_id=session_id, 
                           latex_content=session_data['latex_content'],
                           models=models, 
-                          current_model=current_model,
-                          has_latex=HAS_LATEX)
+                          current_model=get_current_model(),
+                          has_latex=HAS_LATEX,
+                          ai_draft_status=ai_draft['status'] if ai_draft else None,
+                          has_preview=HAS_LATEX and HAS_PDFTOPPM)
 
 @app.route('/compile/<session_id>', methods=['POST'])
 def compile_latex_route(session_id):
@@ -686,6 +3061,32 @@ def compile_latex_route(session_id):
     raw_latex_content = request.form['latex_content'] 
     processed_latex_content = raw_latex_content # Use the content directly
     # --- END: Removed unnecessary text processing ---
+
+    mode = request.form.get('mode', 'final')
+    if mode not in COMPILE_MODES:
+        return jsonify({'error': f"Unknown compile mode '{mode}', expected one of {', '.join(COMPILE_MODES)}"}), 400
+
+    # Reject obviously broken documents before spending any pdflatex passes on them
+    preflight_errors = preflight_latex(processed_latex_content, [os.path.join(app.config['UPLOAD_FOLDER'], session_id)])
+    if preflight_errors:
+        print(f"--- [POST /compile] Preflight found {len(preflight_errors)} error(s) for {session_id}, skipping pdflatex ---", file=sys.stderr)
+        if mode == 'check':
+            return jsonify({'ok': False, 'timed_out': False, 'errors': preflight_errors, 'warnings': [], 'usage': summarize_compile_usage([])})
+        return jsonify({'error': 'LaTeX preflight check failed', 'errors': preflight_errors}), 422
+
+    # The revision may already have been compiled speculatively after it was saved
+    speculative = take_speculative_result(session_id, processed_latex_content, mode) if mode != 'check' else None
+    if speculative:
+        pdf_bytes, usage, synctex_bytes = speculative
+        print(f"--- [POST /compile] Serving speculative compile for {session_id} ---", file=sys.stderr)
+        try:
+            store_session_pdf(session_id, pdf_bytes, processed_latex_content, synctex_bytes)
+        except Exception as e:
+            print(f"--- [POST /compile] Could not store PDF for {session_id}: {e} ---", file=sys.stderr)
+        response = send_bytes(pdf_bytes, 'application/pdf', f'{session_id}_paper.pdf')
+        response.headers['X-Compile-Usage'] = json.dumps(usage)
+        response.headers['X-Compile-Speculative'] = 'hit'
+        return response
     
     # Create a temporary directory for compilation
     temp_dir = tempfile.mkdtemp()
@@ -695,46 +3096,62 @@ def compile_latex_route(session_id):
     
     success = False
     log_output = ""
+    compile_results = []
 
+    # A syntax check is a single draft pass, too cheap to be worth pausing or cancelling background compiles for
+    if mode != 'check':
+        begin_foreground_compile(session_id, content_hash(processed_latex_content))
     try:
         # Write the PROCESSED LaTeX content to the .tex file
         with open(latex_file_path, 'w', encoding='utf-8') as f:
             f.write(processed_latex_content)
+        stage_session_images(session_id, temp_dir)
         
         print(f"--- [POST /compile] Wrote processed LaTeX to {latex_file_path} ---", file=sys.stderr)
         
         # --- START: Adapted pdflatex calls --- 
-        # Run pdflatex compilation steps within the temporary directory
+        # Run pdflatex compilation steps within the temporary directory, under the compile sandbox limits
         try:
-            # First pass
-            cmd = ['pdflatex', '-interaction=nonstopmode', 'paper.tex']
-            print(f"--- [POST /compile] Running command: {' '.join(cmd)} in {temp_dir} ---", file=sys.stderr)
-            result = subprocess.run(cmd, cwd=temp_dir, check=True, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-            log_output += result.stdout + "\n" + result.stderr + "\n"
-            
-            # Second pass (often needed for references, TOC, etc.)
-            print(f"--- [POST /compile] Running command: {' '.join(cmd)} in {temp_dir} (2nd pass) ---", file=sys.stderr)
-            result = subprocess.run(cmd, cwd=temp_dir, check=True, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-            log_output += result.stdout + "\n" + result.stderr
-
+            # pdflatex (and bibtex with the library's entries when the document has a bibliography);
+            # check mode only needs one pass
+            print(f"--- [POST /compile] Running {mode} compile in {temp_dir} ---", file=sys.stderr)
+            job = run_compile_job(temp_dir, processed_latex_content, mode)
+            compile_results = job['results']
+            log_output += job['log']
+            result = compile_results[-1]
+
+            usage = summarize_compile_usage(compile_results)
+            print(f"--- [POST /compile] Resource usage for {session_id}: {usage} ---", file=sys.stderr)
+
+            if mode == 'check':
+                # Syntax check only: no PDF was written, report diagnostics and stop here
+                errors, warnings = parse_latex_log(log_output)
+                return jsonify({
+                    'ok': job['ok'] and not errors,
+                    'timed_out': usage['timed_out'],
+                    'errors': errors,
+                    'warnings': warnings,
+                    'usage': usage
+                })
+            elif usage['timed_out']:
+                print(f"--- [POST /compile] LaTeX compilation for {session_id} killed after {COMPILE_TIMEOUT_SECONDS}s ---", file=sys.stderr)
+                log_output += f"\nCompilation was stopped after exceeding the {COMPILE_TIMEOUT_SECONDS}s time limit."
+            elif not job['ok']:
+                print(f"--- [POST /compile] LaTeX compilation failed for {session_id} with exit code {result['returncode']} ---", file=sys.stderr)
+                # Try to read log file even if process failed
+                if os.path.exists(log_path):
+                    try:
+                        with open(log_path, 'r', encoding='utf-8', errors='ignore') as log_file:
+                            log_output += "\n--- Log File Content ---\n" + log_file.read()
+                    except Exception as log_read_e:
+                        print(f"--- [POST /compile] Error reading log file {log_path}: {log_read_e} ---", file=sys.stderr)            
             # Check if PDF exists after compilation
-            if os.path.exists(pdf_file_path):
+            elif os.path.exists(pdf_file_path):
                 success = True
                 print(f"--- [POST /compile] Compilation successful (PDF found) for {session_id} ---", file=sys.stderr)
             else:
                  print(f"--- [POST /compile] Compilation seemingly finished but PDF not found for {session_id} ---", file=sys.stderr)
 
-        except subprocess.CalledProcessError as e:
-            print(f"--- [POST /compile] LaTeX compilation failed for {session_id} with CalledProcessError: {e} ---", file=sys.stderr)
-            log_output += e.stdout + "\n" + e.stderr if e.stdout else ""
-            log_output += e.stderr if e.stderr else ""
-            # Try to read log file even if process failed
-            if os.path.exists(log_path):
-                try:
-                    with open(log_path, 'r', encoding='utf-8', errors='ignore') as log_file:
-                        log_output += "\n--- Log File Content ---\n" + log_file.read()
-                except Exception as log_read_e:
-                    print(f"--- [POST /compile] Error reading log file {log_path}: {log_read_e} ---", file=sys.stderr)            
         except Exception as e:
             # Catch other potential errors during subprocess execution
             print(f"--- [POST /compile] Unexpected error during pdflatex execution: {e} ---", file=sys.stderr)
@@ -742,7 +3159,15 @@ def compile_latex_route(session_id):
         # --- END: Adapted pdflatex calls --- 
 
         if success:
-            return send_file(pdf_file_path, as_attachment=True, download_name=f'{session_id}_paper.pdf')
+            with open(pdf_file_path, 'rb') as pdf_file:
+                pdf_bytes = pdf_file.read()
+            try:
+                store_session_pdf(session_id, pdf_bytes, processed_latex_content, read_synctex(temp_dir))
+            except Exception as e:
+                print(f"--- [POST /compile] Could not store PDF for {session_id}: {e} ---", file=sys.stderr)
+            response = send_bytes(pdf_bytes, 'application/pdf', f'{session_id}_paper.pdf')
+            response.headers['X-Compile-Usage'] = json.dumps(summarize_compile_usage(compile_results))
+            return response
         else:
             print(f"--- [POST /compile] Returning compilation failure response for {session_id} ---", file=sys.stderr)
             # Ensure log_output has content, provide default if empty after errors
@@ -761,7 +3186,10 @@ def compile_latex_route(session_id):
             if len(log_output) > max_log_length:
                 log_output = log_output[-max_log_length:] + "\n... (log truncated)"
                 
-            return jsonify({'error': 'LaTeX compilation failed', 'log': log_output}), 500
+            usage = summarize_compile_usage(compile_results)
+            error = 'LaTeX compilation timed out' if usage['timed_out'] else 'LaTeX compilation failed'
+            errors, _ = parse_latex_log(log_output)
+            return jsonify({'error': error, 'log': log_output, 'errors': errors, 'usage': usage}), 500
             
     except Exception as e:
         # Catch errors during file writing or other steps before compilation
@@ -771,6 +3199,8 @@ def compile_latex_route(session_id):
         traceback.print_exc(file=sys.stderr) 
         return jsonify({'error': f'An unexpected error occurred: {e}'}), 500
     finally:
+        if mode != 'check':
+            end_foreground_compile()
         # Clean up the temporary directory
         try:
             if temp_dir and os.path.exists(temp_dir):
@@ -781,10 +3211,10 @@ def compile_latex_route(session_id):
 
 @app.route('/set_model', methods=['POST'])
 def set_model():
-    global current_model
     model_key = request.form.get('model')
     if model_key in models:
-        current_model = models[model_key]
+        # Stored in the signed session cookie: affects only this user, in every worker
+        session['model'] = models[model_key]
         flash(f'Model switched to {model_key}')
     return redirect(request.referrer or url_for('index'))
 
@@ -819,9 +3249,10 @@ def api_modify_latex():
             
             session_data['latex_content'] = modified_latex # Update the content
             
-            with open(session_file_path, 'w') as f:
-                json.dump(session_data, f, indent=4) # Save it back
+            save_session(session_id, session_data) # Save it back
             print(f"--- Successfully updated session file {session_id} with Gemini modifications ---", file=sys.stderr)
+            # The user usually compiles next: get a head start on it
+            schedule_speculative_compile(session_id, modified_latex)
             
         except Exception as e:
             print(f"Error updating session file {session_id} after Gemini modification: {e}", file=sys.stderr)
@@ -839,25 +3270,193 @@ def api_modify_latex():
         # Returning original content might be less confusing for the user than an empty editor
         return jsonify({'error': f'Error modifying content with Gemini: {e}', 'latex_content': latex_content}), 500 
 
+@app.route('/api/llm_stats', methods=['GET'])
+def api_llm_stats():
+    # Per worker process: hedge rate and backup win rate help tune LLM_HEDGE_PERCENTILE
+    return jsonify(get_llm_stats())
+
+@app.route('/api/admission_stats', methods=['GET'])
+def api_admission_stats():
+    # Per worker process: queue depth, rejections and service time for each pool
+    return jsonify({pool.name: pool.snapshot() for pool in admission_pools.values()})
+
+@app.route('/api/bibliography', methods=['GET'])
+def api_bibliography():
+    # Look up the local bibliography library by ?key=, ?doi= or title words in ?q=
+    entries = search_bibliography(key=request.args.get('key'), doi=request.args.get('doi'), title=request.args.get('q'))
+    return jsonify({'entries': [{field: entry[field] for field in ('key', 'type', 'title', 'author', 'year', 'doi')}
+                                for entry in entries]})
+
+@app.route('/admin/profiles', methods=['GET'])
+def admin_profiles():
+    if not is_profile_authorized():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'profiles': list_profiles()})
+
+@app.route('/admin/profiles/<profile_id>/<kind>', methods=['GET'])
+def admin_profile_download(profile_id, kind):
+    """pstats: load with pstats.Stats / snakeviz; collapsed: flamegraph.pl or speedscope; text: top functions."""
+    if not is_profile_authorized() or not re.fullmatch(r'[0-9a-f]{32}', profile_id):
+        return jsonify({'error': 'Not found'}), 404
+    base_path = os.path.join(PROFILE_DIR, profile_id)
+    if not os.path.exists(f"{base_path}.json"):
+        return jsonify({'error': 'Profile not found'}), 404
+    if kind == 'pstats':
+        return send_file(f"{base_path}.pstats", mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f"{profile_id}.pstats")
+    if kind == 'collapsed':
+        return send_file(f"{base_path}.collapsed", mimetype='text/plain', as_attachment=True,
+                         download_name=f"{profile_id}.collapsed")
+    if kind == 'text':
+        output = StringIO()
+        pstats.Stats(f"{base_path}.pstats", stream=output).sort_stats('cumulative').print_stats(40)
+        return app.response_class(output.getvalue(), mimetype='text/plain')
+    return jsonify({'error': f"Unknown profile format '{kind}', expected pstats, collapsed or text"}), 400
+
+@app.route('/api/ai_draft/<session_id>', methods=['GET'])
+def api_ai_draft(session_id):
+    # Polled by the editor while the LLM structures an upload that started from the offline draft
+    if load_session(session_id) is None:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify(load_ai_draft(session_id) or {'status': 'none'})
+
+@app.route('/api/outline/<session_id>', methods=['GET', 'POST'])
+def api_outline(session_id):
+    """Structural outline for the editor sidebar.
+
+    GET outlines the saved document, POST outlines unsaved editor content sent as
+    JSON {'latex_content': ...}. Both are served from the per-revision index cache.
+    """
+    session_data = load_session(session_id)
+    if session_data is None:
+        return jsonify({'error': 'Session not found'}), 404
+
+    latex_content = session_data['latex_content']
+    if request.method == 'POST':
+        latex_content = (request.get_json(silent=True) or {}).get('latex_content', latex_content)
+
+    index = get_document_index(latex_content)
+    return jsonify({
+        'revision': index['revision'],
+        'sections': index['sections'],
+        'environments': index['environments'],
+        'labels': index['labels'],
+        'citations': index['citations'],
+        'cite_all': index['cite_all'],
+        'graphics': index['graphics'],
+        'undefined_refs': index['undefined_refs'],
+    })
+
+@app.route('/api/preview/<session_id>', methods=['POST'])
+def api_preview(session_id):
+    """Finds the page showing an editor line and returns the URL of that page's image.
+
+    Body: {"latex_content": ..., "line": 1-based line, "dpi": resolution}. Compiles
+    only if this revision has no PDF with SyncTeX data yet.
+    """
+    if load_session(session_id) is None:
+        return jsonify({'error': 'Session not found'}), 404
+    if not HAS_LATEX or not HAS_PDFTOPPM:
+        return jsonify({'error': 'Page preview needs pdflatex and pdftoppm (poppler-utils) on the server.'}), 501
+    data = request.get_json(silent=True) or {}
+    latex_content = data.get('latex_content')
+    if not latex_content:
+        latex_content = load_session(session_id).get('latex_content', '')
+    try:
+        line = max(1, int(data.get('line', 1)))
+        dpi = min(max(int(data.get('dpi', PREVIEW_DEFAULT_DPI)), 36), PREVIEW_MAX_DPI)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'line and dpi must be integers'}), 400
+
+    build, errors = get_preview_build(session_id, latex_content)
+    if build is None:
+        print(f"--- [POST /api/preview] Compile failed for {session_id} ---", file=sys.stderr)
+        return jsonify({'error': 'LaTeX compilation failed', 'errors': errors}), 422
+    page = min(find_page_for_line(build, line), len(build['page_hashes']))
+    page_hash = build['page_hashes'][page - 1]
+    return jsonify({
+        'revision': build['revision'],
+        'page': page,
+        'pages': len(build['page_hashes']),
+        'page_hash': page_hash,
+        'image_url': url_for('api_preview_page', session_id=session_id, page_hash=page_hash, page=page, dpi=dpi),
+    })
+
+@app.route('/api/preview/<session_id>/page/<page_hash>.png', methods=['GET'])
+def api_preview_page(session_id, page_hash):
+    # The URL names the page by content hash, so the image never changes and browsers may keep it
+    if not re.fullmatch(r'[0-9a-f]{64}', page_hash):
+        return jsonify({'error': 'Invalid page'}), 400
+    dpi = min(max(request.args.get('dpi', PREVIEW_DEFAULT_DPI, type=int), 36), PREVIEW_MAX_DPI)
+    png_path = os.path.join(get_preview_dir(session_id), f"{page_hash}_{dpi}.png")
+    if not os.path.exists(png_path):
+        build = load_preview_build(session_id)
+        if not build or page_hash not in build['page_hashes']:
+            return jsonify({'error': 'Page not found, request the preview again'}), 404
+        page = request.args.get('page', type=int)
+        if not page or not 0 < page <= len(build['page_hashes']) or build['page_hashes'][page - 1] != page_hash:
+            page = build['page_hashes'].index(page_hash) + 1
+        png_path = render_preview_page(session_id, build, page, dpi)
+        if png_path is None:
+            return jsonify({'error': 'Could not render the page'}), 500
+    response = send_file(png_path, mimetype='image/png', etag=f"{page_hash}-{dpi}", max_age=365 * 24 * 3600)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/download_latex/<session_id>', methods=['GET'])
 def download_latex(session_id):
     # Load the session data
-    import json
-    session_file = os.path.join(app.config['UPLOAD_FOLDER'], session_id, f"{session_id}_session.json")
+    session_data = load_session(session_id)
     
-    if not os.path.exists(session_file):
+    if session_data is None:
         flash('Session not found')
         return redirect(url_for('index'))
     
-    with open(session_file, 'r') as f:
-        session_data = json.load(f)
+    # Serve straight from the session store, no temp file needed
+    return send_bytes(session_data['latex_content'], 'application/x-tex', 'research_paper.tex')
+
+@app.route('/download_pdf/<session_id>', methods=['GET'])
+def download_pdf(session_id):
+    session_data = load_session(session_id)
+    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], session_id, 'paper.pdf')
     
-    # Create a temp file for the LaTeX content
-    temp_latex_file = os.path.join(app.config['UPLOAD_FOLDER'], f"download_{session_id}.tex")
-    with open(temp_latex_file, 'w', encoding='utf-8') as f:
-        f.write(session_data['latex_content'])
+    if session_data is None or not os.path.exists(pdf_path):
+        return jsonify({'error': 'No compiled PDF for this session'}), 404
+
+    # Answer revalidation from the stored hash without touching the PDF itself
+    pdf_hash = session_data.get('pdf_hash')
+    if pdf_hash and request.if_none_match.contains(pdf_hash):
+        response = app.response_class(status=304)
+        response.set_etag(pdf_hash)
+        return response
+
+    with open(pdf_path, 'rb') as f:
+        pdf_bytes = f.read()
+    return send_bytes(pdf_bytes, 'application/pdf', 'research_paper.pdf', etag=pdf_hash)
+
+@app.route('/download_bundle/<session_id>', methods=['GET'])
+def download_bundle(session_id):
+    session_data = load_session(session_id)
     
-    return send_file(temp_latex_file, as_attachment=True, download_name='research_paper.tex')
+    if session_data is None:
+        flash('Session not found')
+        return redirect(url_for('index'))
+
+    members = get_bundle_members(session_id, session_data)
+    etag = get_bundle_etag(members)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    # The archive is generated while it is sent, nothing is staged on disk
+    response = app.response_class(stream_zip(members), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename='research_paper.zip')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
@@ -868,11 +3467,25 @@ def upload_image():
     
     if file.filename == '':
         return jsonify({'error': 'No selected image'}), 400
+
+    if not allowed_image(file.filename):
+        return jsonify({'error': 'Image type not allowed'}), 400
+
+    session_id = request.form.get('session_id', '')
+    session_file_path = os.path.join(app.config['UPLOAD_FOLDER'], session_id, f"{session_id}_session.json")
+    if not session_id or not os.path.exists(session_file_path):
+        return jsonify({'error': 'Session not found'}), 404
     
     if file:
         filename = secure_filename(file.filename)
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], f"img_{uuid.uuid4()}_{filename}")
-        file.save(image_path)
+        try:
+            stored_name, duplicate = ingest_image(file.read(), get_session_images_dir(session_id))
+        except Exception as e:
+            print(f"Error processing uploaded image {filename}: {e}", file=sys.stderr)
+            return jsonify({'error': 'Unsupported or corrupt image'}), 400
+
+        # Images live in the session's images/ directory, which is staged into every compile directory
+        image_path = f"images/{stored_name}"
         
         # Generate LaTeX code to include the image using RAW f-string with DOUBLE CURLY BRACES for literals
         # Note: {image_path} and {filename.split('.')[0]} are variables, keep single braces
@@ -886,7 +3499,8 @@ def upload_image():
         return jsonify({
             'success': True,
             'latex_code': latex_code,
-            'image_path': image_path
+            'image_path': image_path,
+            'duplicate': duplicate
         })
     
     return jsonify({'error': 'Error uploading image'}), 500
@@ -0,0 +1,90 @@
+"""Benchmark for DOCX text extraction.
+
+Generates a long DOCX (headings, paragraphs, bullet lists and tables; about 150
+pages by default) with python-docx, then compares the streaming
+extract_text_from_docx against the previous python-docx based extractor.
+Each extractor runs in its own process so its peak memory can be measured.
+
+Usage: python benchmark_docx.py [pages]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from docx import Document
+
+PARAGRAPH = ("Quantum machine learning investigates how quantum computing can enhance machine learning "
+             "algorithms. Variational circuits are trained with classical optimizers, and noise remains "
+             "the main obstacle on current hardware. ") * 3
+
+
+def build_document(path, pages):
+    doc = Document()
+    doc.add_heading('Benchmark Paper', 0)
+    for page in range(pages):
+        doc.add_heading(f'Section {page + 1}', 1)
+        doc.add_paragraph(PARAGRAPH)
+        doc.add_heading('Details', 2)
+        doc.add_paragraph(PARAGRAPH)
+        for item in range(3):
+            doc.add_paragraph(f'Point {item + 1} of section {page + 1}', style='List Bullet')
+        table = doc.add_table(rows=4, cols=3)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = 'cell value'
+    doc.save(path)
+
+
+def extract_with_python_docx(file_path):
+    # The extractor used before the streaming reader
+    doc = Document(file_path)
+    return '\n'.join([paragraph.text for paragraph in doc.paragraphs])
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec on Linux and would report the parent's peak, VmHWM does not
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_one(extractor, path):
+    """Child process: extract once and print 'seconds chars peak_memory_increase_mb'."""
+    if extractor == 'streaming':
+        from app import extract_text_from_docx as extract
+    else:
+        extract = extract_with_python_docx
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    text = extract(path)
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed} {len(text)} {peak_rss_mb() - baseline}")
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'benchmark.docx')
+        build_document(path, pages)
+        print(f"Document: ~{pages} pages, {os.path.getsize(path) / 1024:.0f} KB on disk")
+        for extractor in ('python-docx', 'streaming'):
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', extractor, path],
+                                    capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed, chars, memory = result.stdout.strip().splitlines()[-1].split()
+            print(f"{extractor:>12}: {float(elapsed) * 1000:8.1f} ms, {int(chars):8d} chars, "
+                  f"+{float(memory):6.1f} MB peak memory")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        run_one(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,63 @@
+"""Benchmark for the in-process LaTeX preflight validator.
+
+Builds a ~1 MB LaTeX document (sections, math, lists, figures, comments and a
+verbatim block per section) and times preflight_latex on it: a first check of
+a revision (the cache is cleared before every run) and a repeated check of the
+same revision, which reuses the cached scan.
+
+Usage: python benchmark_preflight.py [target_size_in_bytes]
+"""
+import sys
+import time
+
+from app import PREFLIGHT_CACHE, preflight_latex
+
+SECTION = r"""
+\section{Section %(n)d}\label{sec:%(n)d}
+Quantum machine learning combines {\em quantum computing} with \textbf{machine learning}.
+We measured 100\%% of the runs, see Section~\ref{sec:%(n)d} and \cite{ref%(n)d}. %% a comment with a } brace
+\begin{equation}
+  E = \sum_{i=1}^{N} \left\{ \frac{p_i^2}{2m} + V(x_i) \right\}
+\end{equation}
+\begin{itemize}
+  \item First point with \emph{emphasis} and inline math $a_{ij} = b^{k}$
+  \item Second point using \verb|{raw}| text
+\end{itemize}
+\begin{verbatim}
+for (i = 0; i < n; i++) { unbalanced {{ in verbatim is fine
+\end{verbatim}
+"""
+
+def build_document(target_size):
+    parts = ["\\documentclass{article}\n\\usepackage{amsmath}\n\\begin{document}\n"]
+    size = len(parts[0])
+    n = 0
+    while size < target_size:
+        section = SECTION % {'n': n}
+        parts.append(section)
+        size += len(section)
+        n += 1
+    parts.append("\\end{document}\n")
+    return ''.join(parts)
+
+def main():
+    target_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024
+    document = build_document(target_size)
+    preflight_latex(document) # Warm up regex caches
+
+    runs = 20
+    print(f"Document size: {len(document) / 1024:.0f} KB, {document.count(chr(10))} lines")
+    for label, clear_cache in (('first check', True), ('repeated check', False)):
+        timings = []
+        for _ in range(runs):
+            if clear_cache:
+                PREFLIGHT_CACHE.clear()
+            start = time.perf_counter()
+            errors = preflight_latex(document)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        print(f"preflight_latex, {label}, over {runs} runs: min {timings[0]:.1f} ms, median {timings[runs // 2]:.1f} ms, max {timings[-1]:.1f} ms")
+    print(f"Errors found: {len(errors)}")
+
+if __name__ == '__main__':
+    main()
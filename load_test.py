@@ -0,0 +1,320 @@
+"""Concurrent load generator for the research paper service.
+
+Drives the real HTTP routes (/upload, /edit, /compile, /api/modify_latex,
+/download_latex, /upload_image) with a configurable number of concurrent
+virtual users and traffic mix, then prints per-endpoint throughput, latency
+percentiles and error rates as JSON.
+
+By default it starts a local instance of the app with a stand-in LLM, so no
+Gemini quota is spent and LLM latency is controlled by --llm-latency:
+
+    python load_test.py --concurrency 16 --duration 30
+    python load_test.py --mix edit=10,download_latex=5,modify=1 --output report.json
+
+Use --url to target an already running instance instead (its real LLM is used).
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+
+DEFAULT_MIX = 'upload=1,edit=6,compile=2,modify=2,download_latex=4,upload_image=1'
+
+SAMPLE_TEXT = """# Machine Learning for Quantum Computing
+
+Quantum computing and machine learning are two of the most promising technological paradigms.
+
+## Background
+
+- Qubits can exist in a superposition of states
+- Entanglement allows correlated measurements
+
+Machine learning enables computers to learn from data and improve with experience.
+"""
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Stand-in for genai.GenerativeModel: sleeps like a real call, then answers sensibly."""
+    latency = 1.0
+
+    def __init__(self, model_name, *args, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, prompt, *args, **kwargs):
+        # Lognormal delay keeps a realistic long tail around the configured median
+        time.sleep(self.latency * random.lognormvariate(0, 0.5))
+        match = re.search(r'```latex\n(.*?)\n\s*```', prompt, re.DOTALL)
+        if match:
+            # Behave like a modification that preserves the document
+            return FakeResponse(match.group(1).strip() + "\n")
+        return FakeResponse("\\documentclass{article}\n\\begin{document}\nGenerated.\n\\end{document}\n")
+
+
+def serve_with_fake_llm(port, llm_latency):
+    """Runs the app in this process with the stand-in LLM (used as a child process)."""
+    import app as app_module
+    FakeGenerativeModel.latency = llm_latency
+    app_module.genai.GenerativeModel = FakeGenerativeModel
+    app_module.app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def start_local_instance(llm_latency):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    cmd = [sys.executable, os.path.abspath(__file__), '--serve-fake-llm', '--port', str(port),
+           '--llm-latency', str(llm_latency)]
+    # All virtual users share one IP, so budget admission per paper session as distinct users would get.
+    # Sessions go to a scratch folder that is removed afterwards, not the repo's uploads/
+    upload_folder = tempfile.mkdtemp(prefix='load_test_uploads_')
+    env = dict(os.environ, UPLOAD_FOLDER=upload_folder)
+    env.setdefault('ADMISSION_CLIENT_KEY', 'session')
+    process = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return process, url, upload_folder
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    shutil.rmtree(upload_folder, ignore_errors=True)
+    raise RuntimeError("Local instance did not start")
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint '{name}' in --mix, expected one of {', '.join(ENDPOINTS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def make_png():
+    try:
+        from PIL import Image
+    except ImportError:
+        # 1x1 transparent PNG
+        return bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                             '1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082')
+    buffer = BytesIO()
+    Image.new('RGB', (random.randint(200, 2000), random.randint(200, 2000)),
+              tuple(random.randint(0, 255) for _ in range(3))).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def create_session(http, url):
+    response = http.post(f"{url}/upload", files={'file': ('paper.md', SAMPLE_TEXT.encode('utf-8'))},
+                         data={'title': 'Load Test Paper', 'authors': 'Load Tester'}, allow_redirects=False)
+    location = response.headers.get('Location', '')
+    if response.status_code != 302 or '/edit/' not in location:
+        return response, None
+    return response, location.rstrip('/').rsplit('/', 1)[-1]
+
+
+def get_latex(http, url, session_id):
+    return http.get(f"{url}/download_latex/{session_id}").text
+
+
+def session_latex(context, session_id):
+    # Sessions created during the run reuse the first seed document as their payload
+    return context['latex'].get(session_id, context['seed_latex'])
+
+
+# Each endpoint function performs one request and returns the response
+def hit_upload(http, url, context):
+    response, session_id = create_session(http, url)
+    if session_id:
+        context['sessions'].append(session_id)
+    return response
+
+
+def hit_edit(http, url, context):
+    return http.get(f"{url}/edit/{random.choice(context['sessions'])}")
+
+
+def hit_compile(http, url, context):
+    session_id = random.choice(context['sessions'])
+    return http.post(f"{url}/compile/{session_id}", data={'latex_content': session_latex(context, session_id)})
+
+
+def hit_modify(http, url, context):
+    session_id = random.choice(context['sessions'])
+    return http.post(f"{url}/api/modify_latex", json={
+        'session_id': session_id,
+        'latex_content': session_latex(context, session_id),
+        'instruction': 'Improve the wording of the introduction'
+    })
+
+
+def hit_download_latex(http, url, context):
+    return http.get(f"{url}/download_latex/{random.choice(context['sessions'])}")
+
+
+def hit_upload_image(http, url, context):
+    return http.post(f"{url}/upload_image", data={'session_id': random.choice(context['sessions'])},
+                     files={'image': ('figure.png', make_png())})
+
+
+ENDPOINTS = {
+    'upload': hit_upload,
+    'edit': hit_edit,
+    'compile': hit_compile,
+    'modify': hit_modify,
+    'download_latex': hit_download_latex,
+    'upload_image': hit_upload_image,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    report = {}
+    for endpoint, results in sorted(samples.items()):
+        latencies = sorted(latency for latency, _, _ in results)
+        errors = sum(1 for _, ok, _ in results if not ok)
+        rejected = sum(1 for _, _, was_rejected in results if was_rejected)
+        report[endpoint] = {
+            'requests': len(results),
+            'errors': errors,
+            'error_rate': round(errors / len(results), 4),
+            'rejected_429': rejected, # Shed by admission control, also counted as errors
+            'throughput_rps': round(len(results) / elapsed, 2),
+            'latency_ms': {
+                'p50': round(percentile(latencies, 0.50), 1),
+                'p95': round(percentile(latencies, 0.95), 1),
+                'p99': round(percentile(latencies, 0.99), 1),
+                'mean': round(sum(latencies) / len(latencies), 1),
+                'max': round(latencies[-1], 1),
+            },
+        }
+    total = sum(len(results) for results in samples.values())
+    total_errors = sum(r['errors'] for r in report.values())
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'total_requests': total,
+        'total_throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+        'total_error_rate': round(total_errors / total, 4) if total else 0,
+        'endpoints': report,
+    }
+
+
+def run_load(url, concurrency, duration, max_requests, weights, seed_sessions):
+    context = {'sessions': [], 'latex': {}}
+    with requests.Session() as http:
+        for _ in range(seed_sessions):
+            _, session_id = create_session(http, url)
+            if session_id:
+                context['sessions'].append(session_id)
+                context['latex'][session_id] = get_latex(http, url, session_id)
+    if not context['sessions']:
+        raise SystemExit("Could not create any session via /upload, is the server healthy?")
+    context['seed_latex'] = context['latex'][context['sessions'][0]]
+
+    names = list(weights)
+    name_weights = [weights[name] for name in names]
+    samples = {name: [] for name in names}
+    lock = threading.Lock()
+    issued = [0]
+    deadline = time.monotonic() + duration
+
+    def virtual_user():
+        with requests.Session() as http:
+            while time.monotonic() < deadline:
+                with lock:
+                    if max_requests and issued[0] >= max_requests:
+                        return
+                    issued[0] += 1
+                endpoint = random.choices(names, name_weights)[0]
+                start = time.perf_counter()
+                try:
+                    response = ENDPOINTS[endpoint](http, url, context)
+                    ok = response.status_code < 400
+                    rejected = response.status_code == 429
+                except requests.RequestException:
+                    ok = rejected = False
+                latency_ms = (time.perf_counter() - start) * 1000
+                with lock:
+                    samples[endpoint].append((latency_ms, ok, rejected))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(virtual_user)
+    elapsed = time.monotonic() - start
+    return summarize({name: results for name, results in samples.items() if results}, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Target an existing instance instead of starting one with a stand-in LLM')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='Test duration in seconds')
+    parser.add_argument('--requests', type=int, default=0, help='Stop after this many requests (0 = no limit)')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Traffic mix as endpoint=weight pairs (default: {DEFAULT_MIX})')
+    parser.add_argument('--sessions', type=int, default=5, help='Sessions created before the run starts')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='Median latency of the stand-in LLM in seconds')
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    parser.add_argument('--serve-fake-llm', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=8003, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_fake_llm:
+        serve_with_fake_llm(args.port, args.llm_latency)
+        return
+
+    weights = parse_mix(args.mix)
+    process = upload_folder = None
+    url = args.url
+    if not url:
+        process, url, upload_folder = start_local_instance(args.llm_latency)
+    try:
+        report = run_load(url, args.concurrency, args.duration, args.requests, weights, args.sessions)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(upload_folder, ignore_errors=True)
+
+    report['config'] = {
+        'url': url if args.url else 'local (stand-in LLM)',
+        'concurrency': args.concurrency,
+        'mix': weights,
+        'llm_latency_s': None if args.url else args.llm_latency,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Checks that admission budgets are kept per paper session with ADMISSION_CLIENT_KEY=session.
+
+Run with: pytest test_admission.py
+"""
+import io
+
+import app
+
+
+def upload_image(client, session_id):
+    data = {'image': (io.BytesIO(b'\x89PNG\r\n\x1a\n'), 'figure.png'), 'session_id': session_id}
+    return client.post('/upload_image', data=data, content_type='multipart/form-data')
+
+
+def test_multipart_uploads_are_budgeted_per_session(monkeypatch):
+    monkeypatch.setattr(app, 'ADMISSION_ENABLED', True)
+    monkeypatch.setattr(app, 'ADMISSION_CLIENT_KEY', 'session')
+    pool = app.AdmissionPool('upload', 4, 4, 1)
+    monkeypatch.setitem(app.admission_pools, 'upload', pool)
+    client = app.app.test_client()
+
+    # An upload of session A is still in flight and uses up that session's budget
+    assert pool.acquire('session:A', 0) is None
+    response = upload_image(client, 'A')
+    assert response.status_code == 429
+    assert response.get_json()['reason'] == 'client_budget'
+
+    # The same browser uploading for another session has a budget of its own
+    response = upload_image(client, 'B')
+    assert response.status_code != 429
+    assert pool.snapshot()['rejected_client_budget'] == 1
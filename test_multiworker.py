@@ -0,0 +1,87 @@
+"""Checks that several app processes behave like one.
+
+Starts two independent server processes (standing in for two gunicorn workers or
+two hosts) that share only an UPLOAD_FOLDER and have no SECRET_KEY configured,
+then verifies that:
+1. A model switched on one worker is seen by the same user on the other worker,
+   and the flash message survives the hop (same cookie signing key).
+2. Another user is unaffected by that switch.
+3. A session created by uploading on one worker can be edited on the other.
+
+Run with: python test_multiworker.py (or pytest test_multiworker.py)
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_worker(port, upload_folder):
+    env = dict(os.environ, UPLOAD_FOLDER=upload_folder)
+    env.pop('SECRET_KEY', None)
+    code = f"import app; app.app.run(host='127.0.0.1', port={port})"
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=APP_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Worker on port {port} did not start")
+
+
+def test_workers_share_model_choice_and_sessions():
+    upload_folder = tempfile.mkdtemp()
+    workers = []
+    try:
+        workers.append(start_worker(free_port(), upload_folder))
+        workers.append(start_worker(free_port(), upload_folder))
+        (_, url_a), (_, url_b) = workers
+
+        # 1. Switch model on worker A, read it back on worker B
+        user = requests.Session()
+        response = user.post(f"{url_a}/set_model", data={'model': 'Flash 1.5'}, allow_redirects=False)
+        assert response.status_code == 302
+        page = user.get(f"{url_b}/").text
+        assert '<option value="Flash 1.5" selected>' in page
+        assert 'Model switched to Flash 1.5' in page
+
+        # 2. Another user still gets the default model
+        other_user = requests.Session()
+        page = other_user.get(f"{url_b}/").text
+        assert '<option value="Pro 1.5" selected>' in page
+
+        # 3. Upload on A, edit the resulting session on B
+        response = user.post(f"{url_a}/upload", files={'file': ('notes.txt', b'Some research notes.')},
+                             allow_redirects=False)
+        assert response.status_code == 302
+        edit_path = response.headers['Location']
+        response = user.get(f"{url_b}{edit_path}")
+        assert response.status_code == 200
+        assert 'Some research notes.' in response.text
+    finally:
+        for process, _ in workers:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(upload_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test_workers_share_model_choice_and_sessions()
+    print("Multi-worker test passed!")
@@ -0,0 +1,53 @@
+"""Checks the LaTeX preflight against valid documents it must not reject and broken ones it must catch.
+
+Run with: pytest test_preflight.py
+"""
+import os
+import tempfile
+
+import pytest
+
+from app import preflight_latex
+
+
+def document(body, preamble=''):
+    return f"\\documentclass{{article}}\n{preamble}\\begin{{document}}\n{body}\n\\end{{document}}\n"
+
+
+@pytest.mark.parametrize('source', [
+    # Macros that open or close an environment where they are used
+    document("\\foo\nCentered\n\\end{center}", "\\def\\foo{\\begin{center}}\n"),
+    document("\\bc\nCentered\n\\ec", "\\newcommand{\\bc}{\\begin{center}}\n\\newcommand\\ec{\\end{center}}\n"),
+    document("\\begin{boxed}Text\\end{boxed}", "\\newenvironment{boxed}[1][]{\\begin{center}}{\\end{center}}\n"),
+    # Inline verbatim with any delimiter, braces included
+    document("Code: \\lstinline|{|"),
+    document("\\lstinline[language=C]!}! and \\lstinline{a{b} and \\mintinline{python}|{|"),
+    document("\\lstinline|100%| is not a comment {}"),
+    # \iffalse blocks are skipped unread
+    document("\\iffalse { \\fi"),
+    document("\\iffalse \\begin{center} \\ifx a b \\fi \\fi Text"),
+])
+def test_valid_documents_pass(source):
+    assert preflight_latex(source) == []
+
+
+@pytest.mark.parametrize('source, message', [
+    (document("{Unclosed"), "Unclosed brace '{'"),
+    (document("\\begin{center}Text\\end{flushleft}"), "\\end{flushleft} without matching \\begin{flushleft}"),
+    (document("\\begin{center}Text", "\\newcommand{\\fig}[1]{\\begin{figure}#1\\end{figure}}\n"),
+     "\\begin{center} is closed by \\end{document} on line 5"),
+    (document("\\iffalse } \\fi }"), "Unmatched closing brace '}'"),
+])
+def test_broken_documents_fail(source, message):
+    assert message in [error['message'] for error in preflight_latex(source)]
+
+
+def test_images_are_looked_up_on_every_check():
+    source = document("\\includegraphics{figure}")
+    with tempfile.TemporaryDirectory() as session_dir:
+        errors = preflight_latex(source, [session_dir])
+        assert [error['message'] for error in errors] == ["Image file 'figure' not found"]
+        # Uploading the image fixes the same (cached) revision
+        with open(os.path.join(session_dir, 'figure.png'), 'wb') as f:
+            f.write(b'\x89PNG')
+        assert preflight_latex(source, [session_dir]) == []
@@ -0,0 +1,72 @@
+"""Checks that a speculative compile a /compile starts waiting for runs at normal priority.
+
+Uses a stand-in pdflatex that takes a moment per pass and records the niceness it
+ran at, so no TeX installation is needed. Run with: pytest test_speculative.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+import app
+
+FAKE_PDFLATEX = f"""#!{sys.executable}
+import os, time
+time.sleep(1)
+with open(os.environ['FAKE_PDFLATEX_LOG'], 'a') as log:
+    log.write(f"{{os.getpriority(os.PRIO_PROCESS, 0)}}\\n")
+with open('paper.pdf', 'wb') as pdf:
+    pdf.write(b'%PDF-1.4 fake')
+"""
+
+LATEX = "\\documentclass{article}\n\\begin{document}\nHello\n\\end{document}\n"
+
+
+@pytest.mark.skipif(app.resource is None or app.SPECULATIVE_COMPILE_NICENESS == 0,
+                    reason="needs process priorities and a non-zero SPECULATIVE_COMPILE_NICENESS")
+def test_promoted_job_runs_at_normal_priority(monkeypatch):
+    with tempfile.TemporaryDirectory() as workdir:
+        bin_dir = os.path.join(workdir, 'bin')
+        os.makedirs(bin_dir)
+        pdflatex = os.path.join(bin_dir, 'pdflatex')
+        with open(pdflatex, 'w') as f:
+            f.write(FAKE_PDFLATEX)
+        os.chmod(pdflatex, 0o755)
+        log_path = os.path.join(workdir, 'niceness.log')
+        monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ['PATH'])
+        monkeypatch.setenv('FAKE_PDFLATEX_LOG', log_path)
+        monkeypatch.setitem(app.app.config, 'UPLOAD_FOLDER', os.path.join(workdir, 'uploads'))
+
+        session_id = 'speculative-test'
+        os.makedirs(os.path.join(app.app.config['UPLOAD_FOLDER'], session_id))
+        app.save_session(session_id, {'latex_content': LATEX})
+        job = {'source_hash': app.content_hash(LATEX), 'mode': 'final', 'cancelled': threading.Event(),
+               'done': threading.Event(), 'started': False, 'promoted': False, 'proc': None,
+               'pdf_bytes': None, 'usage': None, 'synctex_bytes': None}
+        app.speculative_jobs[session_id] = job
+        worker = threading.Thread(target=app.run_speculative_compile, args=(session_id, LATEX, job))
+        worker.start()
+        try:
+            deadline = time.monotonic() + 10
+            while job['proc'] is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert job['proc'] is not None
+            # Not promoted yet: the first pass runs in the background at low priority
+            assert os.getpriority(os.PRIO_PROCESS, job['proc'].pid) == app.SPECULATIVE_COMPILE_NICENESS
+
+            result = app.take_speculative_result(session_id, LATEX, 'final')
+        finally:
+            worker.join(30)
+
+        assert result is not None and result[0].startswith(b'%PDF')
+        with open(log_path) as log:
+            niceness = [int(line) for line in log.read().split()]
+        assert len(niceness) == 2
+        # The pass that was running is set back to normal priority where the OS allows it
+        if os.geteuid() == 0:
+            assert niceness[0] == 0
+        # Passes started after the promotion never run at low priority
+        assert niceness[1:] == [0]
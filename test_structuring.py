@@ -0,0 +1,25 @@
+"""Checks offline structuring and the LaTeX escaping it runs on every paragraph.
+
+Run with: pytest test_structuring.py
+"""
+from app import escape_latex, structure_paper_locally
+
+
+def test_escape_latex_ascii_input():
+    assert escape_latex("Plain 50% of a_1 & b # c ~ ^") == (
+        "Plain 50\\% of a\\_1 \\& b \\# c \\textasciitilde{} \\textasciicircum{}")
+
+
+def test_escape_latex_non_ascii_input_is_still_filtered():
+    # Only ASCII input skips the character filter; everything else goes through it as before
+    assert escape_latex("Naïve café: 50% of α_1 & 🟢 done") == "Nave caf: 50\\% of \\_1 \\&  done"
+
+
+def test_structuring_non_ascii_input():
+    text = ("Résumé of Café Studies\n\n"
+            "Abstract: We study naïve café effects on 50% of users.\n\n"
+            "Introduction: Coffee 🟢 matters.")
+    latex = structure_paper_locally(text, None)
+    assert latex.isascii()
+    assert "\\begin{abstract}\nWe study nave caf effects on 50\\% of users.\n\\end{abstract}" in latex
+    assert "\\section{Introduction}\nCoffee  matters." in latex